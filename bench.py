@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+# Headless benchmarks for the hot paths (no Streamlit needed):
+#
+#   simulation   simulate_surface (default and low_memory) over a matrix of
+#                grid sizes and pothole counts
+#   storage      insert_data / insert_many / get_data / query / in_bbox /
+#                fill_estimate / the work_queue feed and claim on synthetic
+#                report tables of several sizes
+#   dashboard    the map page data preparation (load_reports + report_frames)
+#                and a rerun served by the incremental report_view
+#
+#     python bench.py                      run and print the results
+#     python bench.py --save               run and store them as the baseline
+#     python bench.py --threshold 0.25     fail when a case is >25% slower
+#                                          than the baseline
+#     python bench.py --quick              smaller matrix, for a quick check
+#
+# Every case records the best time of --repeat runs and the peak Python
+# memory (tracemalloc, numpy arrays included) of one run. The results are
+# written to --output as JSON. A case regresses when its best time is
+# more than --threshold above the baseline (or its peak memory is, with
+# --check-memory); any regression makes the exit status 1. So does a
+# MISMATCH, an incremental result (the cached map view) that differs from
+# the same data computed from scratch.
+
+BASELINE = "bench_baseline.json"
+
+FULL = {
+    "grid_sizes": [100, 300, 1000, 2000],
+    "pothole_counts": [5, 300, 3000],
+    "table_sizes": [1000, 10000, 50000],
+}
+QUICK = {
+    "grid_sizes": [100, 300],
+    "pothole_counts": [5, 300],
+    "table_sizes": [1000],
+}
+
+
+def measure(fn, repeat):
+    # (best seconds, peak MB) of fn(); the best run is the least disturbed
+    # by the rest of the machine, which keeps the comparison stable
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 1e6
+
+
+def bench_simulation(matrix, repeat, results):
+    import simulation
+
+    for grid_size in matrix["grid_sizes"]:
+        for num_potholes in matrix["pothole_counts"]:
+            name = f"simulation/grid={grid_size}/potholes={num_potholes}"
+            results[name] = measure(lambda: simulation.simulate_surface(grid_size, num_potholes, seed=50), repeat)
+            _report(name, results[name])
+            name = f"simulation/low_memory/grid={grid_size}/potholes={num_potholes}"
+            results[name] = measure(lambda: simulation.simulate_surface(grid_size, num_potholes, seed=50,
+                                                                        low_memory=True), repeat)
+            _report(name, results[name])
+
+
+def _photo():
+    from PIL import Image
+
+    buffered = BytesIO()
+    Image.new("RGB", (640, 480), (90, 90, 90)).save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def _synthetic_reports(count, photo, rng):
+    states = ["Kerala", "Tamil Nadu", "Karnataka", "Maharashtra"]
+    for i in range(count):
+        lat, long = rng.uniform(8, 30), rng.uniform(70, 90)
+        state = states[i % len(states)]
+        address = {"display_name": f"Road {i}, {state}, India", "lat": lat, "lon": long,
+                   "address": {"road": f"Road {i}", "city": f"City {i % 50}", "county": "",
+                               "postcode": "600001", "state": state, "country": "India"}}
+        # a few distinct photos, like repeat reports of the same damage
+        yield (f"user{i}@example.com", "9876543210", address, None, photo + bytes([i % 8]),
+               rng.uniform(0.1, 2), rng.uniform(0.01, 0.3), rng.uniform(0.1, 2))
+
+
+def bench_storage(matrix, repeat, results, mismatches):
+    import data_storage
+    import dashboard_data
+    import fill_estimate
+    import geo
+    import image_store
+    import work_queue
+
+    photo = _photo()
+    rng = random.Random(50)
+    workdir = tempfile.mkdtemp(prefix="ecoroad-bench-")
+    old_db, old_store = data_storage.db, image_store.STORE_DIR
+    image_store.STORE_DIR = os.path.join(workdir, "images")
+    try:
+        for size in matrix["table_sizes"]:
+            data_storage.db = os.path.join(workdir, f"bench_{size}.db")
+            reports = list(_synthetic_reports(size, photo, rng))
+
+            name = f"storage/insert_many/rows={size}"
+            start = time.perf_counter()
+            data_storage.insert_many(reports)
+            results[name] = (time.perf_counter() - start, None)
+            _report(name, results[name])
+
+            name = f"storage/insert_data/rows={size}"
+            results[name] = measure(lambda: data_storage.insert_data(*reports[0]), repeat)
+            _report(name, results[name])
+
+            cases = {
+                "get_data": lambda: data_storage.get_data("slno, lat, long, city, state, status"),
+                "query_state_page": lambda: data_storage.query(["slno", "city"], state="Kerala", limit=500),
+                "in_bbox": lambda: data_storage.in_bbox("slno", 10, 76, 12, 78),
+                "nearest10": lambda: data_storage.nearest("slno", 10, 76, 10),
+                # cold: reads the dimension columns again every time
+                "fill_estimate": lambda: (fill_estimate.clear_cache(), fill_estimate.backlog_estimate()),
+                "next_jobs": lambda: work_queue.next_jobs(20, state="Kerala"),
+                "claim": lambda: work_queue.claim("bench", 5),
+            }
+            # everything verified, so claim() has the whole table to pick from
+            data_storage.write(lambda conn: conn.execute("update user_data set status = ?", (work_queue.VERIFIED,)))
+            bbox = geo.viewport_bbox(19, 80, 6)
+            cases["dashboard_prep"] = lambda: dashboard_data.report_frames(dashboard_data.load_reports(bbox, limit=5000))
+            # a rerun of the map page with nothing new, served from the cached view
+            dashboard_data.clear_views()
+            cases["dashboard_rerun"] = lambda: dashboard_data.report_view(bbox, limit=5000)
+            for case, fn in cases.items():
+                group = "dashboard" if case.startswith("dashboard_") else "storage"
+                name = f"{group}/{case}/rows={size}"
+                results[name] = measure(fn, repeat)
+                _report(name, results[name])
+
+            # the incremental view has to match a full reload after a report
+            # is stored and then changed before the next rerun
+            dashboard_data.report_view(bbox)
+            inside = next(r for r in reports if bbox[0] <= r[2]["lat"] <= bbox[2] and bbox[1] <= r[2]["lon"] <= bbox[3])
+            work_queue.verify([data_storage.insert_data(*inside)])
+            _, df_view, _ = dashboard_data.report_view(bbox)
+            _, df_full = dashboard_data.report_frames(dashboard_data.load_reports(bbox))
+            if not df_view.equals(df_full):
+                mismatches.append(f"dashboard/report_view/rows={size}: {len(df_view)} rows, a full reload has {len(df_full)}")
+    finally:
+        data_storage.db, image_store.STORE_DIR = old_db, old_store
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _report(name, result):
+    seconds, peak = result
+    peak = f"{peak:9.1f} MB" if peak is not None else "        -"
+    print(f"{name:55s} {seconds * 1000:10.2f} ms {peak}", flush=True)
+
+
+def compare(results, baseline, threshold, check_memory):
+    regressions = []
+    for name, (seconds, peak) in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if seconds > base["seconds"] * (1 + threshold):
+            regressions.append(f"{name}: {seconds * 1000:.2f} ms vs {base['seconds'] * 1000:.2f} ms baseline")
+        if check_memory and peak is not None and base.get("peak_mb") and peak > base["peak_mb"] * (1 + threshold):
+            regressions.append(f"{name}: {peak:.1f} MB vs {base['peak_mb']:.1f} MB baseline")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EcoRoad performance benchmarks")
+    parser.add_argument("--quick", action="store_true", help="smaller matrix")
+    parser.add_argument("--only", choices=["simulation", "storage"], help="run one group")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case (the best is kept)")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline JSON (default: %(default)s)")
+    parser.add_argument("--output", default="bench_results.json", help="where to write this run")
+    parser.add_argument("--save", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument("--check-memory", action="store_true", help="also fail on peak memory growth")
+    args = parser.parse_args()
+
+    matrix = QUICK if args.quick else FULL
+    results = {}
+    mismatches = []  # incremental results that differ from a full recompute
+    if args.only in (None, "simulation"):
+        bench_simulation(matrix, args.repeat, results)
+    if args.only in (None, "storage"):
+        bench_storage(matrix, args.repeat, results, mismatches)
+
+    for line in mismatches:
+        print("MISMATCH", line)
+    out = {name: {"seconds": s, "peak_mb": p} for name, (s, p) in results.items()}
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=2, sort_keys=True)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+        sys.exit(1 if mismatches else 0)
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.check_memory)
+        for line in regressions:
+            print("REGRESSION", line)
+        sys.exit(1 if regressions or mismatches else 0)
+    print(f"no baseline at {args.baseline}, run with --save to create one")
+    sys.exit(1 if mismatches else 0)
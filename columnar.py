@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pds
+
+import data_storage
+import timing
+
+# Columnar (Arrow) access to the reports.
+#
+#     python columnar.py export reports_parquet --by state
+#     python columnar.py export reports_parquet --by month --thumbs
+#
+# record_batches() streams user_data as Arrow record batches: rows are read
+# BATCH_ROWS at a time by slno (keyset paging) and each batch is turned
+# into typed Arrow columns in one go, so no Python code runs per row.
+# export() writes those batches to a Parquet dataset, hive partitioned by
+# state or month (state=Kerala/..., month=2025-04/...), next to a
+# _watermark.json with the data_storage change_seq() / last_slno() taken
+# before the export started. The photos never go into it, the thumbnails
+# only with thumbs=True.
+#
+# rows_to_table() is the same conversion for rows already fetched, and
+# read_export() loads (a bounding box of) an export back as an Arrow table,
+# which is bound by disk reads instead of the interpreter. Both give
+# DataFrames through Table.to_pandas().
+
+BATCH_ROWS = 50000
+WATERMARK = "_watermark.json"
+
+TYPES = {
+    "slno": pa.int64(),
+    "lat": pa.float64(),
+    "long": pa.float64(),
+    "breadth": pa.float64(),
+    "length": pa.float64(),
+    "height": pa.float64(),
+    "img_width": pa.int64(),
+    "img_height": pa.int64(),
+    "img_blob": pa.binary(),
+}  # everything else is text
+EXPORT_COLUMNS = [i for i in data_storage.COLUMNS if i not in ("img_blob", "thumb")]
+PARTITIONS = {"state": "state", "month": "datime"}  # partition -> column it comes from
+
+
+def schema(columns):
+    return pa.schema([(name, TYPES.get(name, pa.string())) for name in columns])
+
+
+def rows_to_table(rows, columns):
+    # list of row tuples (in the order of columns) -> Arrow table
+    target = schema(columns)
+    if not rows:
+        return target.empty_table()
+    return pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(zip(*rows), target)],
+                                schema=target)
+
+
+def record_batches(columns=EXPORT_COLUMNS, batch_size=BATCH_ROWS, **filters):
+    # user_data (filtered like data_storage.query) as Arrow record batches,
+    # ordered by slno; slno is always included
+    columns = data_storage._columns(columns)
+    if "slno" not in columns:
+        columns = columns + ["slno"]
+    key = columns.index("slno")
+    after = filters.pop("after", None)
+    while True:
+        with timing.span("columnar.batch"):
+            rows = data_storage.query(columns, limit=batch_size, after=after, **filters)
+            if not rows:
+                return
+            after = rows[-1][key]
+            batch = rows_to_table(rows, columns).to_batches()[0]
+        yield batch
+        if len(rows) < batch_size:
+            return
+
+
+@timing.timed("columnar.export")
+def export(out_dir, partition_by="state", columns=EXPORT_COLUMNS, thumbs=False, batch_size=BATCH_ROWS, **filters):
+    # write the reports to a Parquet dataset in out_dir, replacing what was
+    # there; returns the number of rows written
+    if partition_by not in PARTITIONS:
+        raise ValueError(f"unknown partition {partition_by!r}")
+    if os.path.exists(out_dir) and os.listdir(out_dir) and watermark(out_dir) is None:
+        # never replace a directory that is not an earlier export
+        raise ValueError(f"{out_dir} is not empty and holds no {WATERMARK}, refusing to replace it")
+    columns = data_storage._columns(columns)
+    if thumbs and "thumb" not in columns:
+        columns = columns + ["thumb"]
+    if "img_blob" in columns:
+        raise ValueError("photos are not exported, they stay in the image store")
+    source = PARTITIONS[partition_by]
+    if source not in columns:
+        columns = columns + [source]
+
+    # watermarks first, like dashboard_data: whatever changes during the
+    # export is picked up again by readers that catch up from them
+    mark = {"seq": data_storage.change_seq(), "last": data_storage.last_slno(), "partition_by": partition_by,
+            "time": time.time()}
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        for batch in record_batches(columns, batch_size, **filters):
+            rows += batch.num_rows
+            if partition_by == "month":
+                batch = batch.append_column("month", pc.utf8_slice_codeunits(batch.column("datime"), 0, 7))
+            yield batch
+
+    target = schema(columns + (["slno"] if "slno" not in columns else []))
+    if partition_by == "month":
+        target = target.append(pa.field("month", pa.string()))
+
+    # written next to the old export and swapped in at the end by two
+    # renames, so readers see the old export or the new one, never half of
+    # one (and no export at all only for the moment between the renames)
+    tmp = f"{out_dir.rstrip(os.sep)}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    pds.write_dataset(batches(), tmp, schema=target, format="parquet",
+                      partitioning=pds.partitioning(pa.schema([target.field(partition_by)]), flavor="hive"),
+                      max_rows_per_group=batch_size)
+    mark["rows"] = rows
+    mark["columns"] = [i for i in target.names if i != "month"]
+    with open(os.path.join(tmp, WATERMARK), "w") as f:
+        json.dump(mark, f)
+    old = None
+    if os.path.exists(out_dir):
+        old = f"{out_dir.rstrip(os.sep)}.old-{os.getpid()}"
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(out_dir, old)
+    os.replace(tmp, out_dir)
+    if old is not None:
+        shutil.rmtree(old)
+    return rows
+
+
+def watermark(out_dir):
+    # the _watermark.json of an export, None when there is none
+    try:
+        with open(os.path.join(out_dir, WATERMARK)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@timing.timed("columnar.read_export")
+def read_export(out_dir, columns=None, bbox=None, limit=None):
+    # Arrow table of the exported reports ordered by slno, optionally only
+    # those inside bbox (min_lat, min_lon, max_lat, max_lon) and only the
+    # first limit of them
+    dataset = pds.dataset(out_dir, format="parquet", partitioning="hive",
+                          exclude_invalid_files=True, ignore_prefixes=["_", "."])
+    expr = None
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        expr = ((pds.field("lat") >= min_lat) & (pds.field("lat") <= max_lat)
+                & (pds.field("long") >= min_lon) & (pds.field("long") <= max_lon))
+    wanted = columns
+    if columns is not None and "slno" not in columns:
+        columns = list(columns) + ["slno"]
+    table = dataset.to_table(columns=columns, filter=expr).sort_by("slno")
+    if limit is not None:
+        table = table.slice(0, limit)
+    return table.select(wanted) if wanted is not None else table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export EcoRoad reports to a partitioned Parquet dataset")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("out_dir", help="dataset directory (replaced when it holds an earlier export)")
+    parser.add_argument("--db", default=data_storage.db, help="database file (default: %(default)s)")
+    parser.add_argument("--by", choices=sorted(PARTITIONS), default="state", help="partition column")
+    parser.add_argument("--thumbs", action="store_true", help="include the thumbnails (for the map dashboard)")
+    parser.add_argument("--batch", type=int, default=BATCH_ROWS, help="rows per record batch")
+    args = parser.parse_args()
+    data_storage.db = args.db
+    start = time.time()
+    try:
+        count = export(args.out_dir, args.by, thumbs=args.thumbs, batch_size=args.batch)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"exported {count} reports to {args.out_dir} in {time.time() - start:.1f}s")
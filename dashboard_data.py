@@ -0,0 +1,166 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow as pa
+
+import columnar
+import data_storage
+import timing
+
+# Data preparation for the map dashboard, kept free of Streamlit so it can be
+# reused (and benchmarked) outside the page.
+#
+# report_view() keeps the frames of the last few viewports in memory for the
+# whole process. On a rerun it only asks the database for reports newer than
+# the slno watermark of the cached frame and for reports in the change log
+# (data_storage.changes_since) since its last refresh, and patches those into
+# the frame; a rerun with nothing new costs two index lookups. The frames are
+# shared between sessions, treat them as read only.
+#
+# Frames are built through Arrow (columnar.rows_to_table), not row by row.
+# When ECOROAD_SNAPSHOT names a Parquet export made with thumbnails
+# (python columnar.py export DIR --thumbs), a viewport is first read from it
+# and then caught up from the export's watermarks, so the first load of a
+# big area reads files instead of pulling every row through sqlite3.
+
+SNAPSHOT_DIR = os.environ.get("ECOROAD_SNAPSHOT")
+
+REPORT_COLUMNS = ["email", "ph_no", "address", "lat", "long", "postcode", "city", "state", "country",
+                  "breadth", "length", "height", "status", "thumb", "slno"]
+
+
+@timing.timed("maps.load_reports")
+def load_reports(bbox, limit=None):
+    # report rows inside the (min_lat, min_lon, max_lat, max_lon) box
+    return data_storage.in_bbox(REPORT_COLUMNS, *bbox, limit=limit)
+
+
+@timing.timed("maps.report_frames")
+def report_frames(data):
+    # rows from load_reports (or an Arrow table of REPORT_COLUMNS) ->
+    # (df_coords, df_data) as used by pages/maps.py
+    table = data if isinstance(data, pa.Table) else columnar.rows_to_table(data, REPORT_COLUMNS)
+    df_data = table.to_pandas().rename(columns={"thumb": "image"})
+    df_data = df_data.set_index("slno")
+    df_data["image"] = df_data["image"].replace("", None)  # photos that could not be read
+
+    # Coordinates for map
+    df_coords = pd.DataFrame({"lat": df_data["lat"].to_numpy(), "lon": df_data["long"].to_numpy()})
+    return df_coords, df_data
+
+
+VIEW_CACHE_ENTRIES = 8
+CHANGE_BATCH = 500  # slnos per refetch query
+
+_views = OrderedDict()  # (bbox, limit) -> view dict
+_views_lock = threading.Lock()  # only around _views and _key_locks themselves
+_key_locks = {}  # (bbox, limit) -> lock held while that view is loaded / refreshed
+
+
+def _inside(df, bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return df["lat"].between(min_lat, max_lat) & df["long"].between(min_lon, max_lon)
+
+
+def _coords(df_data):
+    return pd.DataFrame({"lat": df_data["lat"].to_numpy(), "lon": df_data["long"].to_numpy()})
+
+
+def _load_view(bbox, limit):
+    # watermarks first: anything stored meanwhile is fetched (again) by the
+    # next refresh, duplicates are dropped there
+    seq, last = data_storage.change_seq(), data_storage.last_slno()
+    data = load_reports(bbox, limit)
+    df_coords, df_data = report_frames(data)
+    return {"seq": seq, "last": last, "coords": df_coords, "data": df_data,
+            "complete": limit is None or len(data) < limit}
+
+
+def _load_snapshot(bbox, limit):
+    # the view as of the Parquet export in SNAPSHOT_DIR, None without a usable one
+    mark = columnar.watermark(SNAPSHOT_DIR) if SNAPSHOT_DIR else None
+    if mark is None or not set(REPORT_COLUMNS) <= set(mark.get("columns", ())):
+        return None
+    table = columnar.read_export(SNAPSHOT_DIR, REPORT_COLUMNS, bbox, limit)
+    df_coords, df_data = report_frames(table)
+    return {"seq": mark["seq"], "last": mark["last"], "coords": df_coords, "data": df_data,
+            "complete": limit is None or table.num_rows < limit}
+
+
+def _refresh(view, bbox, limit):
+    # patch the reports added or changed since the view was loaded into it;
+    # returns None when the view has to be loaded again instead
+    seq, changed = data_storage.changes_since(view["seq"])
+    last = data_storage.last_slno()
+    if not changed and last == view["last"]:
+        return view
+    df_data = view["data"]
+    if len(changed) > max(CHANGE_BATCH, len(df_data) // 2):
+        return None  # cheaper to start over
+
+    parts = []
+    if changed:
+        rows = []
+        for i in range(0, len(changed), CHANGE_BATCH):
+            rows += data_storage.query(REPORT_COLUMNS, slno=changed[i:i + CHANGE_BATCH])
+        _, df_changed = report_frames(rows)
+        df_changed = df_changed[_inside(df_changed, bbox)]
+        if not view["complete"]:
+            # reports past the end of a truncated view stay out of it, but
+            # one gaining or losing rows inside its range has to be reloaded
+            df_changed = df_changed[df_changed.index <= df_data.index.max()]
+            if df_changed.index.difference(df_data.index).size or \
+                    df_data.index.isin(changed).sum() > len(df_changed):
+                return None
+        df_data = df_data.drop(index=df_data.index.intersection(changed))
+        parts.append(df_changed)
+    if last != view["last"] and view["complete"]:
+        _, df_new = report_frames(data_storage.in_bbox(REPORT_COLUMNS, *bbox, after=view["last"]))
+        # new reports changed since are in df_changed already
+        parts.append(df_new[~df_new.index.isin(changed)])
+
+    # rows stored while the view was being loaded can come back once more
+    parts = [part[~part.index.isin(df_data.index)] for part in parts]
+    if any(len(part) for part in parts):
+        df_data = pd.concat([df_data, *parts])
+        df_data = df_data[~df_data.index.duplicated(keep="last")]
+        if not df_data.index.is_monotonic_increasing:
+            df_data = df_data.sort_index()
+    if view["complete"] and limit is not None and len(df_data) >= limit:
+        return None  # grew past the limit, let the query pick the first rows
+    return {"seq": seq, "last": last, "coords": _coords(df_data), "data": df_data, "complete": view["complete"]}
+
+
+@timing.timed("maps.report_view")
+def report_view(bbox, limit=None):
+    # (df_coords, df_data, complete) for the reports inside bbox, like
+    # report_frames(load_reports(bbox, limit)) but incremental across reruns;
+    # complete is False when the limit cut the result short
+    key = (tuple(bbox), limit)
+    with _views_lock:
+        lock = _key_locks.setdefault(key, threading.Lock())
+    # the database work runs under the lock of this viewport only, other
+    # viewports (and sessions) do not wait for it
+    with lock:
+        with _views_lock:
+            view = _views.get(key)
+        if view is None:
+            view = _load_snapshot(bbox, limit)
+        view = _refresh(view, bbox, limit) if view is not None else None
+        if view is None:
+            view = _load_view(bbox, limit)
+        with _views_lock:
+            _views[key] = view
+            _views.move_to_end(key)
+            while len(_views) > VIEW_CACHE_ENTRIES:
+                old, _ = _views.popitem(last=False)
+                _key_locks.pop(old, None)
+    return view["coords"], view["data"], view["complete"]
+
+
+def clear_views():
+    with _views_lock:
+        _views.clear()
+        _key_locks.clear()
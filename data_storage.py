@@ -1,58 +1,653 @@
+import queue
 import sqlite3 as sq
+import threading
+from concurrent.futures import Future
+
+import db_pool
+import geo
+import image_processing
+import image_store
+import timing
 db="user_database.db"
-conn=sq.connect(database=db)
-
-
-conn.execute("""create table if not exists user_data (
-    slno INTEGER PRIMARY KEY AUTOINCREMENT,
-    email TEXT  NOT NULL,
-    ph_no TEXT  NOT NULL,
-    address TEXT,
-    lat REAL,
-    long REAL,
-    postcode TEXT,
-    city TEXT,
-    state TEXT,
-    country TEXT,
-    img_name TEXT,
-    img_blob BLOB,
-    breadth REAL,
-    length REAL,
-    height REAL,
-    status TEXT,
-    datime DATETIME DEFAULT (datetime('now', '+5 hours', '30 minutes'))
-) """)
-
-conn.close()
 
+# -------------------- Connections --------------------
+# Reads use a pooled connection per thread (db_pool), so neither calls nor
+# page reruns open the file again. The database runs in WAL mode, so readers are never
+# blocked by a writer, and all writes go through one writer thread that
+# groups whatever is waiting into a single transaction (WRITE_BATCH jobs at
+# most). Concurrent submitters therefore never fight over the write lock
+# and never see "database is locked".
+WRITE_BATCH = 256
+CLUSTER_MAX_ZOOM = 14
+HAS_RTREE = True
 
-def insert_data(email,ph_no,address,pic_name,a,breadth,height,length):
-    k=0
-    for i in address["address"]:
+_init_lock = threading.Lock()
+_initialized = set()
+_writers = {}
+
+
+def _open(path):
+    conn = sq.connect(database=path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("pragma journal_mode=wal")
+    conn.execute("pragma synchronous=normal")  # safe with WAL, fsync only at checkpoints
+    conn.execute("pragma busy_timeout=30000")
+    conn.execute("pragma cache_size=-16000")  # 16 MB page cache per connection
+    conn.execute("pragma temp_store=memory")
+    conn.execute("pragma mmap_size=268435456")
+    return conn
+
+
+def init_db(path=None):
+    # create / upgrade the schema once per process and database file
+    path = path or db
+    if path in _initialized:
+        return
+    with _init_lock:
+        if path in _initialized:
+            return
+        conn = sq.connect(database=path, timeout=30)
+        try:
+            conn.execute("pragma journal_mode=wal")
+            _create_schema(conn)
+        finally:
+            conn.close()
+        _initialized.add(path)
+
+
+def connect():
+    # this thread's connection to the current database, for reads
+    init_db(db)
+    return db_pool.connection(db, _open)
+
+
+def _writer_loop(path, jobs):
+    conn = _open(path)
+    while True:
+        batch = [jobs.get()]
+        while len(batch) < WRITE_BATCH:
+            try:
+                batch.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+        outcomes = []
+        try:
+            conn.execute("begin immediate")
+            for fn, future in batch:
+                # a savepoint per job, so one failing job does not undo the others
+                conn.execute("savepoint job")
+                try:
+                    outcomes.append((future, fn(conn), None))
+                    conn.execute("release job")
+                except Exception as e:
+                    conn.execute("rollback to job")
+                    conn.execute("release job")
+                    outcomes.append((future, None, e))
+            conn.execute("commit")
+        except sq.Error as e:
+            # the whole batch is lost, report it to every caller
+            if conn.in_transaction:
+                conn.execute("rollback")
+            outcomes = [(future, None, e) for _, future in batch]
+        # results are only handed out once they are committed
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def write(fn):
+    # run fn(conn) on the writer thread inside a transaction, returns its result
+    init_db(db)
+    with _init_lock:
+        writer = _writers.get(db)
+        if writer is None or not writer[0].is_alive():
+            jobs = queue.Queue()
+            thread = threading.Thread(target=_writer_loop, args=(db, jobs), name="data-storage-writer", daemon=True)
+            thread.start()
+            writer = _writers[db] = (thread, jobs)
+    future = Future()
+    writer[1].put((fn, future))
+    return future.result()
+
+
+# -------------------- Schema --------------------
+
+# estimated fill volume of a report in m3, the repair queue priority
+FILL_VOLUME = "coalesce(breadth * length * height, 0)"
+
+def _create_schema(conn):
+    global HAS_RTREE
+    conn.execute("""create table if not exists user_data (
+        slno INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT  NOT NULL,
+        ph_no TEXT  NOT NULL,
+        address TEXT,
+        lat REAL,
+        long REAL,
+        postcode TEXT,
+        city TEXT,
+        state TEXT,
+        country TEXT,
+        img_name TEXT,
+        img_blob BLOB,
+        breadth REAL,
+        length REAL,
+        height REAL,
+        status TEXT,
+        datime DATETIME DEFAULT (datetime('now', '+5 hours', '30 minutes')),
+        thumb TEXT,
+        img_width INTEGER,
+        img_height INTEGER
+    ) """)
+
+    # databases created before thumbnails / photo dimensions / the repair
+    # queue (work_queue.py) existed
+    existing = [i[1] for i in conn.execute("pragma table_info(user_data)")]
+    for name, kind in (("thumb", "TEXT"), ("img_width", "INTEGER"), ("img_height", "INTEGER"),
+                       ("crew", "TEXT"), ("status_changed", "DATETIME")):
+        if name not in existing:
+            conn.execute(f"alter table user_data add column {name} {kind}")
+    conn.commit()
+
+    # indexes for the filtered / paged queries below
+    conn.execute("create index if not exists user_data_status on user_data (status, slno)")
+    conn.execute("create index if not exists user_data_place on user_data (state, city, slno)")
+    conn.execute("create index if not exists user_data_datime on user_data (datime)")
+    # the repair queue: jobs of one status by priority (estimated fill
+    # volume, biggest first), optionally in one state and / or city, by age,
+    # and the
+    # jobs a crew holds. The priority is an expression index, queries must
+    # order by exactly FILL_VOLUME to use it.
+    conn.execute(f"create index if not exists user_data_priority on user_data (status, {FILL_VOLUME} desc, slno)")
+    conn.execute(f"""create index if not exists user_data_status_place
+                     on user_data (status, state, city, {FILL_VOLUME} desc, slno)""")
+    # state and city are both optional on the crew page, each filter gets
+    # an index that is already in priority order
+    conn.execute(f"""create index if not exists user_data_status_state
+                     on user_data (status, state, {FILL_VOLUME} desc, slno)""")
+    conn.execute(f"""create index if not exists user_data_status_city
+                     on user_data (status, city, {FILL_VOLUME} desc, slno)""")
+    conn.execute("create index if not exists user_data_status_datime on user_data (status, datime)")
+    conn.execute("create index if not exists user_data_crew on user_data (crew, status) where crew is not null")
+    conn.commit()
+
+    # Spatial index: an R*Tree over the report coordinates, kept in sync with
+    # user_data by triggers. SQLite builds without the rtree module fall back to
+    # a plain (lat, long) index, which is slower but gives the same answers.
+    try:
+        conn.execute("create virtual table if not exists user_data_geo using rtree (id, min_lat, max_lat, min_lon, max_lon)")
+        HAS_RTREE = True
+    except sq.OperationalError:
+        HAS_RTREE = False
+
+    if HAS_RTREE:
+        conn.executescript("""
+            create trigger if not exists user_data_geo_insert after insert on user_data
+            when new.lat is not null and new.long is not null begin
+                insert into user_data_geo values (new.slno, new.lat, new.lat, new.long, new.long);
+            end;
+            create trigger if not exists user_data_geo_update after update of lat, long on user_data begin
+                delete from user_data_geo where id = old.slno;
+                insert into user_data_geo select new.slno, new.lat, new.lat, new.long, new.long
+                    where new.lat is not null and new.long is not null;
+            end;
+            create trigger if not exists user_data_geo_delete after delete on user_data begin
+                delete from user_data_geo where id = old.slno;
+            end;
+        """)
+        # rows stored before the index existed
+        if conn.execute("select count(*) from user_data_geo").fetchone()[0] != \
+                conn.execute("select count(*) from user_data where lat is not null and long is not null").fetchone()[0]:
+            conn.execute("""insert or replace into user_data_geo
+                            select slno, lat, lat, long, long from user_data where lat is not null and long is not null""")
+        conn.commit()
+    else:
+        conn.execute("create index if not exists user_data_latlong on user_data (lat, long)")
+        conn.commit()
+
+    # Map clusters: for every zoom level 0..CLUSTER_MAX_ZOOM the reports are
+    # counted in a lat/lon grid of cells about 64 px wide at that zoom
+    # (90 / 2^zoom degrees). Triggers keep the counts, coordinate sums and total
+    # damage volume (breadth x length x height) up to date on every insert,
+    # update and delete, so the map can draw one marker per cell.
+    conn.executescript("""
+        create table if not exists cluster_levels (zoom INTEGER PRIMARY KEY, cell REAL NOT NULL);
+        create table if not exists report_clusters (
+            zoom INTEGER NOT NULL,
+            cell_lat INTEGER NOT NULL,
+            cell_lon INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum_lat REAL NOT NULL,
+            sum_lon REAL NOT NULL,
+            volume REAL NOT NULL,
+            PRIMARY KEY (zoom, cell_lat, cell_lon)
+        ) WITHOUT ROWID;
+
+        create trigger if not exists report_clusters_insert after insert on user_data
+        when new.lat is not null and new.long is not null begin
+            insert into report_clusters
+                select zoom, cast((new.lat + 90) / cell as integer), cast((new.long + 180) / cell as integer),
+                       1, new.lat, new.long, coalesce(new.breadth * new.length * new.height, 0)
+                from cluster_levels where true
+            on conflict (zoom, cell_lat, cell_lon) do update set
+                count = count + 1, sum_lat = sum_lat + excluded.sum_lat,
+                sum_lon = sum_lon + excluded.sum_lon, volume = volume + excluded.volume;
+        end;
+
+        create trigger if not exists report_clusters_delete after delete on user_data
+        when old.lat is not null and old.long is not null begin
+            update report_clusters set
+                count = count - 1, sum_lat = sum_lat - old.lat, sum_lon = sum_lon - old.long,
+                volume = volume - coalesce(old.breadth * old.length * old.height, 0)
+            where (zoom, cell_lat, cell_lon) in (
+                select zoom, cast((old.lat + 90) / cell as integer), cast((old.long + 180) / cell as integer)
+                from cluster_levels);
+            delete from report_clusters where count <= 0;
+        end;
+
+        create trigger if not exists report_clusters_update after update of lat, long, breadth, length, height on user_data begin
+            update report_clusters set
+                count = count - 1, sum_lat = sum_lat - old.lat, sum_lon = sum_lon - old.long,
+                volume = volume - coalesce(old.breadth * old.length * old.height, 0)
+            where old.lat is not null and old.long is not null and (zoom, cell_lat, cell_lon) in (
+                select zoom, cast((old.lat + 90) / cell as integer), cast((old.long + 180) / cell as integer)
+                from cluster_levels);
+            delete from report_clusters where count <= 0;
+            insert into report_clusters
+                select zoom, cast((new.lat + 90) / cell as integer), cast((new.long + 180) / cell as integer),
+                       1, new.lat, new.long, coalesce(new.breadth * new.length * new.height, 0)
+                from cluster_levels where new.lat is not null and new.long is not null
+            on conflict (zoom, cell_lat, cell_lon) do update set
+                count = count + 1, sum_lat = sum_lat + excluded.sum_lat,
+                sum_lon = sum_lon + excluded.sum_lon, volume = volume + excluded.volume;
+        end;
+    """)
+    if conn.execute("select count(*) from cluster_levels").fetchone()[0] != CLUSTER_MAX_ZOOM + 1:
+        conn.execute("delete from cluster_levels")
+        conn.executemany("insert into cluster_levels values (?, ?)",
+                         [(z, 90.0 / 2 ** z) for z in range(CLUSTER_MAX_ZOOM + 1)])
+        conn.execute("delete from report_clusters")
+    # rebuild when the counts do not match the reports (new table, older rows)
+    if conn.execute("select coalesce(sum(count), 0) from report_clusters where zoom = 0").fetchone()[0] != \
+            conn.execute("select count(*) from user_data where lat is not null and long is not null").fetchone()[0]:
+        conn.execute("delete from report_clusters")
+        conn.execute("""insert into report_clusters
+                        select zoom, cast((lat + 90) / cell as integer) cy, cast((long + 180) / cell as integer) cx,
+                               count(*), sum(lat), sum(long), coalesce(sum(breadth * length * height), 0)
+                        from user_data, cluster_levels where lat is not null and long is not null
+                        group by zoom, cy, cx""")
+    conn.commit()
+
+    # Summary statistics: report count and damaged volume per
+    # (state, city, status), kept current by triggers so totals cost
+    # O(number of groups) instead of a pass over every report.
+    conn.executescript("""
+        create table if not exists report_stats (
+            state TEXT NOT NULL,
+            city TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            volume REAL NOT NULL,
+            PRIMARY KEY (state, city, status)
+        ) WITHOUT ROWID;
+
+        create trigger if not exists report_stats_insert after insert on user_data begin
+            insert into report_stats values (coalesce(new.state, ''), coalesce(new.city, ''), coalesce(new.status, ''),
+                                             1, coalesce(new.breadth * new.length * new.height, 0))
+            on conflict (state, city, status) do update set
+                count = count + 1, volume = volume + excluded.volume;
+        end;
+
+        create trigger if not exists report_stats_delete after delete on user_data begin
+            update report_stats set count = count - 1,
+                volume = volume - coalesce(old.breadth * old.length * old.height, 0)
+            where state = coalesce(old.state, '') and city = coalesce(old.city, '') and status = coalesce(old.status, '');
+            delete from report_stats where count <= 0;
+        end;
+
+        create trigger if not exists report_stats_update
+        after update of state, city, status, breadth, length, height on user_data begin
+            update report_stats set count = count - 1,
+                volume = volume - coalesce(old.breadth * old.length * old.height, 0)
+            where state = coalesce(old.state, '') and city = coalesce(old.city, '') and status = coalesce(old.status, '');
+            delete from report_stats where count <= 0;
+            insert into report_stats values (coalesce(new.state, ''), coalesce(new.city, ''), coalesce(new.status, ''),
+                                             1, coalesce(new.breadth * new.length * new.height, 0))
+            on conflict (state, city, status) do update set
+                count = count + 1, volume = volume + excluded.volume;
+        end;
+    """)
+    if conn.execute("select coalesce(sum(count), 0) from report_stats").fetchone()[0] != \
+            conn.execute("select count(*) from user_data").fetchone()[0]:
+        conn.execute("delete from report_stats")
+        conn.execute("""insert into report_stats
+                        select coalesce(state, ''), coalesce(city, ''), coalesce(status, ''),
+                               count(*), coalesce(sum(breadth * length * height), 0)
+                        from user_data group by 1, 2, 3""")
+    conn.commit()
+
+    # Change log for incremental readers (the map dashboard): every update or
+    # delete of a report moves its slno to the end of report_changes, so
+    # "what changed since seq N" is a range scan. New reports are found by
+    # their slno instead, inserts are not logged.
+    conn.executescript("""
+        create table if not exists report_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            slno INTEGER NOT NULL UNIQUE
+        );
+        create trigger if not exists report_changes_update after update on user_data begin
+            insert or replace into report_changes (slno) values (new.slno);
+        end;
+        create trigger if not exists report_changes_delete after delete on user_data begin
+            insert or replace into report_changes (slno) values (old.slno);
+        end;
+    """)
+    conn.commit()
+
+
+# columns that may be asked for by name, anything else is rejected before it
+# gets anywhere near the SQL text
+COLUMNS = ("slno", "email", "ph_no", "address", "lat", "long", "postcode", "city", "state",
+           "country", "img_name", "img_blob", "breadth", "length", "height", "status", "datime", "thumb",
+           "img_width", "img_height", "crew", "status_changed")
+
+
+INSERT_SQL = """INSERT INTO user_data (email, ph_no, address, lat, long, postcode, city, state, country, img_name, img_blob, breadth, length, height,status, thumb, img_width, img_height)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?,?,?,?)"""
+
+
+def _report_row(email,ph_no,address,pic_name,a,breadth,height,length,thumbs=None,preview=None):
+    # the photo goes to the image store and only its reference is kept in
+    # the row; pass a=None when pic_name already is a stored reference.
+    # preview is (thumb, width, height) when the caller made it already
+    # Nominatim leaves out whatever it does not know (rural points often have
+    # no postcode), missing parts are stored empty. The locality is the part
+    # just before county (city, town, village, ...).
+    parts=address.get("address") or {}
+    k=None
+    for i in parts:
         if i=="county":
             break
         else:
             k=i
-    with sq.connect(database="user_database.db") as conn:
-        cursor=conn.cursor()
-        cursor.execute("""
-                      INSERT INTO user_data (email, ph_no, address, lat, long, postcode, city, state, country, img_name, img_blob, breadth, length, height,status)
-                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?)
-                  """, (
-        email, ph_no, address["display_name"], address["lat"], address["lon"], address["address"]["postcode"],address["address"][k], address["address"]["state"], address["address"]["country"], pic_name, a, breadth,
-        length, height,"s"))
-        conn.commit()
+    place=(address.get("display_name",""),address["lat"],address["lon"],parts.get("postcode",""),
+           parts.get(k,"") if k is not None else "",parts.get("state",""),parts.get("country",""))
+    if a is not None:
+        pic_name=image_store.put(a)
+    else:
+        a=image_store.read(pic_name)
+    # preview for the map dashboard and the photo size, made once here instead
+    # of on every page load (and once per distinct photo when thumbs is a dict
+    # shared by a batch)
+    if preview is not None:
+        thumb,width,height_px=preview
+    elif thumbs is not None and pic_name in thumbs:
+        thumb,width,height_px=thumbs[pic_name]
+    else:
+        try:
+            thumb=image_processing.make_thumbnail(a)
+        except Exception:
+            thumb=""
+        width,height_px=image_processing.image_size(a) if a is not None else (None,None)
+        if thumbs is not None:
+            thumbs[pic_name]=(thumb,width,height_px)
+    return (email, ph_no, *place, pic_name, None, breadth,
+            length, height,"s",thumb,width,height_px)
+
+
+@timing.timed("db.insert_data")
+def insert_data(email,ph_no,address,pic_name,a,breadth,height,length):
+    row=_report_row(email,ph_no,address,pic_name,a,breadth,height,length)
+    return write(lambda conn: conn.execute(INSERT_SQL, row).lastrowid)
+
+
+@timing.timed("db.insert_many")
+def insert_many(reports,previews=None,then=None,errors=None):
+    # reports: iterable of insert_data argument tuples, stored in one
+    # transaction; returns the new slnos in order. previews: optional
+    # (thumb, width, height) per report (see _report_row), then: optional
+    # fn(conn) run in the same transaction, e.g. to record progress.
+    # With a list as errors, a report that cannot be turned into a row adds
+    # (its position, the exception) there and gets None instead of a slno.
+    reports=list(reports)
+    thumbs={}
+    rows=[]
+    for n,(report,preview) in enumerate(zip(reports,previews or [None]*len(reports))):
+        try:
+            rows.append(_report_row(*report,thumbs=thumbs,preview=preview))
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.append((n,e))
+            rows.append(None)
+
+    def insert(conn):
+        slnos=[conn.execute(INSERT_SQL, row).lastrowid if row is not None else None for row in rows]
+        if then is not None:
+            then(conn)
+        return slnos
+    return write(insert)
+
+
+def _columns(columns):
+    # "a, b" or ["a", "b"] -> ["a", "b"], only known columns allowed
+    if isinstance(columns, str):
+        columns = columns.split(",")
+    columns = [i.strip() for i in columns if i.strip()]
+    for i in columns:
+        if i not in COLUMNS:
+            raise ValueError(f"unknown column {i!r}")
+    return columns
+
+
+def _filters(status=None, city=None, state=None, since=None, until=None, after=None, slno=None):
+    # where clause and parameters; status/city/state/slno take one value or a list,
+    # since/until are datime bounds ('YYYY-MM-DD[ HH:MM:SS]', until is exclusive),
+    # after is the last slno already seen (keyset paging)
+    where, params = [], []
+    for name, value in (("status", status), ("city", city), ("state", state), ("slno", slno)):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = list(value)
+            where.append(f"{name} in ({','.join('?' * len(value))})")
+            params.extend(value)
+        else:
+            where.append(f"{name} = ?")
+            params.append(value)
+    if since is not None:
+        where.append("datime >= ?")
+        params.append(str(since))
+    if until is not None:
+        where.append("datime < ?")
+        params.append(str(until))
+    if after is not None:
+        where.append("slno > ?")
+        params.append(after)
+    return (" where " + " and ".join(where) if where else ""), params
+
+
+@timing.timed("db.query")
+def query(columns, limit=None, **filters):
+    # rows (tuples, in the order of columns) ordered by slno, see _filters for
+    # the filter arguments. Pass the last slno of a page as after= to get the
+    # next one; this stays fast however deep the page is.
+    columns = _columns(columns)
+    where, params = _filters(**filters)
+    sql = f"select {', '.join(columns)} from user_data{where} order by slno"
+    if limit is not None:
+        sql += " limit ?"
+        params.append(int(limit))
+    return connect().execute(sql, params).fetchall()
+
+
+def iter_query(columns, chunk_size=500, **filters):
+    # generator form of query, reads chunk_size rows at a time so the whole
+    # table is never held in memory
+    columns = _columns(columns)
+    extra = "slno" not in columns
+    key = len(columns) if extra else columns.index("slno")
+    select = columns + ["slno"] if extra else columns
+    after = filters.pop("after", None)
+    while True:
+        rows = query(select, limit=chunk_size, after=after, **filters)
+        if not rows:
+            return
+        after = rows[-1][key]
+        for row in rows:
+            yield row[:-1] if extra else row
+        if len(rows) < chunk_size:
+            return
+
+
+def get_data(col_name, **filters):
+    return list(query(col_name, **filters))
+
+
+@timing.timed("db.get_image")
+def get_image(slno):
+    # full size photo of one report, only loaded when that report is opened
+    row=connect().execute("select img_name, img_blob from user_data where slno = ?",(slno,)).fetchone()
+    if row is None:
+        return None
+    # rows not yet moved by migrate_images.py still carry the bytes
+    return row[1] if row[1] is not None else image_store.read_bytes(row[0])
+
+
+def backfill_thumbnails(batch=100):
+    # make thumbnails for reports stored before the thumb column existed
+    done=0
+    while True:
+        rows=connect().execute("select slno, img_name, img_blob from user_data where thumb is null limit ?",(batch,)).fetchall()
+        if not rows:
+            break
+        thumbs=[]
+        for slno,name,blob in rows:
+            try:
+                thumbs.append((image_processing.make_thumbnail(blob if blob is not None else image_store.read(name)),slno))
+            except Exception:
+                thumbs.append(("",slno))  # unreadable image, do not try again
+        write(lambda conn: conn.executemany("update user_data set thumb = ? where slno = ?",thumbs))
+        done+=len(rows)
+    return done
+
+
+# -------------------- Spatial queries --------------------
+
+@timing.timed("db.bbox_query")
+def _bbox_query(columns, min_lat, min_lon, max_lat, max_lon, limit=None, **filters):
+    where, params = _filters(**filters)
+    where = where.replace(" where ", " and ", 1)
+    # with after= only the reports newer than a known slno are wanted, a
+    # range scan of the primary key is then cheaper than the whole box
+    if HAS_RTREE and filters.get("after") is None:
+        # the R*Tree stores float32 boxes, so re-check the exact coordinates.
+        # cross join keeps the R*Tree as the outer loop, otherwise the planner
+        # may pick the status index and scan every matching report
+        sql = f"""select {', '.join(columns)} from user_data_geo g cross join user_data on slno = g.id
+                  where g.max_lat >= ? and g.min_lat <= ? and g.max_lon >= ? and g.min_lon <= ?
+                  and lat between ? and ? and long between ? and ?{where} order by slno"""
+        params = [min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon] + params
+    else:
+        sql = f"""select {', '.join(columns)} from user_data
+                  where lat between ? and ? and long between ? and ?{where} order by slno"""
+        params = [min_lat, max_lat, min_lon, max_lon] + params
+    if limit is not None:
+        sql += " limit ?"
+        params.append(int(limit))
+    return connect().execute(sql, params).fetchall()
+
+
+def in_bbox(columns, min_lat, min_lon, max_lat, max_lon, limit=None, **filters):
+    # reports inside a lat/lon box (e.g. the map viewport), ordered by slno;
+    # takes the same filters as query()
+    return _bbox_query(_columns(columns), min_lat, min_lon, max_lat, max_lon, limit, **filters)
+
+
+def _with_distance(columns, lat, lon, radius_km, **filters):
+    # (distance_km, row) for the reports within radius_km, nearest first
+    columns = _columns(columns)
+    rows = _bbox_query(columns + ["lat", "long"], *geo.radius_bbox(lat, lon, radius_km), **filters)
+    found = []
+    for row in rows:
+        d = geo.haversine_km(lat, lon, row[-2], row[-1])
+        if d <= radius_km:
+            found.append((d, row[:-2]))
+    found.sort(key=lambda i: i[0])
+    return found
+
+
+def within_radius(columns, lat, lon, radius_km, **filters):
+    # reports within radius_km of lat/lon, nearest first
+    return [row for _, row in _with_distance(columns, lat, lon, radius_km, **filters)]
+
+
+def last_slno():
+    # newest report number, 0 for an empty table
+    return connect().execute("select coalesce(max(slno), 0) from user_data").fetchone()[0]
+
+
+def change_seq():
+    # position in the change log, pass it to changes_since() later
+    return connect().execute("select coalesce(max(seq), 0) from report_changes").fetchone()[0]
+
+
+def changes_since(seq):
+    # (new seq, [slno]) of the reports updated or deleted after seq
+    rows = connect().execute("select seq, slno from report_changes where seq > ? order by seq", (seq,)).fetchall()
+    return (rows[-1][0] if rows else seq), [slno for _, slno in rows]
+
+
+@timing.timed("db.coordinate_center")
+def coordinate_center():
+    # mean (lat, long) of all reports, None when there are none
+    row = connect().execute("select avg(lat), avg(long) from user_data where lat is not null").fetchone()
+    return row if row[0] is not None else None
+
 
+def nearest(columns, lat, lon, k=10, start_km=1.0, **filters):
+    # k nearest reports to lat/lon, nearest first. The search circle doubles
+    # until it holds k reports; everything outside it is then further away.
+    radius = start_km
+    while True:
+        found = _with_distance(columns, lat, lon, radius, **filters)
+        if len(found) >= k or radius >= geo.EARTH_RADIUS_KM * 3.2:
+            return [row for _, row in found[:k]]
+        radius *= 2
 
 
-def get_data(col_name):
-    with sq.connect(database=db,check_same_thread=False) as conn:
-        cursor=conn.cursor()
-        print(f"select {col_name}  from user_data where status = 's'")
-        cursor.execute(f"select {col_name}  from user_data")
-        return list(cursor.fetchall())
+@timing.timed("db.get_clusters")
+def get_clusters(zoom, min_lat, min_lon, max_lat, max_lon):
+    # (lat, long, count, volume) per cluster cell touching the box, lat/long
+    # being the mean position of the reports in the cell
+    zoom = max(0, min(int(zoom), CLUSTER_MAX_ZOOM))
+    cell = 90.0 / 2 ** zoom
+    return connect().execute("""select sum_lat / count, sum_lon / count, count, volume from report_clusters
+                             where zoom = ? and cell_lat between ? and ? and cell_lon between ? and ?""",
+                          (zoom, int((min_lat + 90) / cell), int((max_lat + 90) / cell),
+                           int((min_lon + 180) / cell), int((max_lon + 180) / cell))).fetchall()
 
 
+# -------------------- Summary statistics --------------------
 
+STATS_GROUPS = ("state", "city", "status")
 
 
+@timing.timed("db.report_summary")
+def report_summary(by=("state",), **filters):
+    # [(group values..., count, volume)] from the report_stats table, grouped
+    # by any of state / city / status and filtered by equality on them, e.g.
+    # report_summary(("city",), state="Kerala"). by=() gives the grand total.
+    if isinstance(by, str):
+        by = (by,)
+    for name in list(by) + list(filters):
+        if name not in STATS_GROUPS:
+            raise ValueError(f"unknown summary group {name!r}")
+    where = " and ".join(f"{name} = ?" for name in filters)
+    sql = f"select {''.join(f'{name}, ' for name in by)}sum(count), sum(volume) from report_stats"
+    if where:
+        sql += " where " + where
+    if by:
+        sql += f" group by {', '.join(by)} order by sum(count) desc"
+    return connect().execute(sql, list(filters.values())).fetchall()
@@ -0,0 +1,83 @@
+import sqlite3 as sq
+import threading
+import weakref
+
+# Process wide pool of SQLite connections.
+#
+#     conn = db_pool.connection("user_database.db", opener)
+#
+# A thread keeps one connection per database file for as long as it runs.
+# The connection comes from a shared pool of idle ones and goes back to it
+# when the thread ends. Streamlit runs every rerun on a new thread, so a
+# rerun picks up the connection an earlier one left behind instead of
+# opening the file (and running its pragmas) again. opener(path) is only
+# called when the pool has no idle connection; at most MAX_IDLE are kept
+# per file.
+#
+# open_wal() is the opener of the small side databases (geocode cache,
+# report queue): WAL, so readers and the writer do not block each other,
+# and the schema created the first time the file is opened in the process.
+
+MAX_IDLE = 8
+
+_idle = {}  # path -> [conn]
+_lock = threading.Lock()
+_local = threading.local()
+_schema_ready = set()  # (path, schema) already set up in this process
+
+
+class _Lease:
+    # lives in the thread's locals, so it is dropped when the thread ends
+    def __init__(self, path, conn):
+        self.conn = conn
+        weakref.finalize(self, _release, path, conn)
+
+
+def _release(path, conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()  # whatever the thread left unfinished
+    except Exception:
+        conn.close()
+        return
+    with _lock:
+        idle = _idle.setdefault(path, [])
+        if len(idle) < MAX_IDLE:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def connection(path, opener):
+    # this thread's connection to path
+    leases = getattr(_local, "leases", None)
+    if leases is None:
+        leases = _local.leases = {}
+    lease = leases.get(path)
+    if lease is None:
+        with _lock:
+            idle = _idle.get(path)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = opener(path)
+        lease = leases[path] = _Lease(path, conn)
+    return lease.conn
+
+
+def open_wal(path, schema):
+    # new connection to path in WAL mode; schema(conn) creates its tables
+    # (inside a transaction), once per process and file
+    conn = sq.connect(database=path, timeout=30, check_same_thread=False)
+    conn.execute("pragma journal_mode=wal")
+    conn.execute("pragma synchronous=normal")
+    with _lock:
+        if (path, schema) not in _schema_ready:
+            with conn:
+                schema(conn)
+            _schema_ready.add((path, schema))
+    return conn
+
+
+def idle_count(path):
+    with _lock:
+        return len(_idle.get(path, ()))
@@ -0,0 +1,90 @@
+import threading
+
+import numpy as np
+
+import data_storage
+import simulation
+import timing
+import work_queue
+
+# Fill material and cost for the stored reports, all at once.
+#
+#     est = fill_estimate.backlog_estimate(selling=40, manu=27)
+#     est["totals"]["selling_price"]
+#
+# Citizens give breadth, length and depth (height) in metres. Each report is
+# filled as the cuboid of those dimensions, priced with the same rate model
+# as the company page (simulation.fill_cost, rates in thousands of rs per
+# m3), and built from BLOCK sized blocks laid over the cuboid.
+#
+# The dimension columns of the pending reports are read once into NumPy
+# arrays and kept until new reports arrive (or pending ones change), which
+# is noticed from the trigger maintained report_stats table and the last
+# slno. Pricing for new rates is one vectorised pass over the arrays.
+
+BLOCK = (0.5, 0.5, 0.1)  # fill block breadth, length, depth in m
+PENDING = work_queue.OPEN  # submitted, verified or scheduled, not filled yet
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _fingerprint(status):
+    # changes whenever a report is added, removed or edited in a way that
+    # matters here; both lookups are a few rows
+    stats = data_storage.report_summary(("status",))
+    last = data_storage.connect().execute("select max(slno) from user_data").fetchone()[0]
+    return status, last, tuple(stats)
+
+
+@timing.timed("fill.load_dimensions")
+def load_dimensions(status=PENDING):
+    # {"slno", "breadth", "length", "height"} NumPy arrays of the reports with
+    # this status, cached until the reports change
+    key = _fingerprint(status)
+    with _cache_lock:
+        cached = _cache.get(status)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+    rows = data_storage.query(["slno", "breadth", "length", "height"], status=status)
+    # missing dimensions count as 0, i.e. nothing to fill
+    table = np.array(rows, dtype=float).reshape(-1, 4)
+    np.nan_to_num(table, copy=False)
+    dims = {"slno": table[:, 0].astype(np.int64), "breadth": table[:, 1],
+            "length": table[:, 2], "height": table[:, 3]}
+    with _cache_lock:
+        _cache[status] = (key, dims)
+    return dims
+
+
+def estimate(breadth, length, height, selling, manu, block=BLOCK):
+    # per report volume (m3), blocks and prices (rs) for dimension arrays in m
+    breadth, length, height = (np.clip(np.asarray(v, dtype=float), 0, None) for v in (breadth, length, height))
+    volume = breadth * length * height
+    # blocks are laid over the whole cuboid, a part block counts as one
+    # (the small epsilon keeps exact multiples from rounding up)
+    blocks = np.ones_like(volume, dtype=np.int64)
+    for size, block_size in zip((breadth, length, height), block):
+        blocks *= np.ceil(size / block_size - 1e-9).astype(np.int64)
+    sp = simulation.fill_cost(volume, selling)
+    mp = simulation.fill_cost(volume, manu)
+    return {"volume": volume, "blocks": blocks, "selling_price": sp,
+            "manufacturing_price": mp, "profit": sp - mp}
+
+
+@timing.timed("fill.backlog_estimate")
+def backlog_estimate(selling=40, manu=27, status=PENDING, block=BLOCK):
+    # estimate() for every report with this status, plus the totals
+    dims = load_dimensions(status)
+    per_report = estimate(dims["breadth"], dims["length"], dims["height"], selling, manu, block)
+    totals = {name: values.sum().item() for name, values in per_report.items()}
+    sp = totals["selling_price"]
+    totals["margin"] = round((sp - totals["manufacturing_price"]) / sp * 100, 2) if sp else 0.0
+    totals["reports"] = len(dims["slno"])
+    return {"slno": dims["slno"], **per_report, "totals": totals}
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
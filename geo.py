@@ -0,0 +1,33 @@
+import math
+
+# Small geometry helpers shared by the storage queries and the map page.
+# Coordinates are plain WGS84 degrees, distances are in km.
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius_km):
+    # smallest lat/lon box holding the circle, as (min_lat, min_lon, max_lat, max_lon)
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    coslat = math.cos(math.radians(lat))
+    if coslat < 1e-6 or radius_km / (EARTH_RADIUS_KM * coslat) >= math.pi:
+        dlon = 180.0
+    else:
+        dlon = math.degrees(math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / coslat)))
+    return max(-90.0, lat - dlat), max(-180.0, lon - dlon), min(90.0, lat + dlat), min(180.0, lon + dlon)
+
+
+def viewport_bbox(lat, lon, zoom, width=1000, height=500):
+    # area shown by a web mercator map (256 px tiles) of width x height pixels
+    # centered on lat/lon, as (min_lat, min_lon, max_lat, max_lon)
+    world = 256 * 2 ** zoom
+    dlon = 360.0 * width / world / 2
+    # latitude span shrinks with 1/cos(lat) on web mercator
+    dlat = 360.0 * height / world / 2 * math.cos(math.radians(lat))
+    return max(-90.0, lat - dlat), max(-180.0, lon - dlon), min(90.0, lat + dlat), min(180.0, lon + dlon)
@@ -0,0 +1,73 @@
+import base64
+import os
+from io import BytesIO
+
+import timing
+
+# Small previews for the map dashboard. They are made once when a report is
+# stored and kept as ready to use data URIs, so the dashboard never has to
+# decode and re-encode the full photos. PIL is imported on first use, so
+# the pages that only read stored thumbnails never load it.
+
+THUMB_SIZE = (160, 160)
+THUMB_QUALITY = 70
+
+
+@timing.timed("image.thumbnail")
+def make_thumbnail(blob, size=THUMB_SIZE, quality=THUMB_QUALITY):
+    from PIL import Image
+
+    image = Image.open(BytesIO(bytes(blob)))
+    image.draft("RGB", size)  # lets the JPEG decoder skip most of the pixels
+    image = image.convert("RGB")
+    image.thumbnail(size)
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=quality, optimize=True)
+    return "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode()
+
+
+# Photos are normalized once, when a report is processed (report_queue
+# workers, ingest.py): the orientation is fixed, the photo is shrunk to fit
+# MAX_DIMENSION and re-encoded as PHOTO_FORMAT at QUALITY. Only the pixels
+# are written, so EXIF (GPS position, camera, time), ICC profiles and
+# comments are dropped. All three are configurable through the environment.
+MAX_DIMENSION = int(os.environ.get("ECOROAD_PHOTO_MAX_DIMENSION", 1600))
+QUALITY = int(os.environ.get("ECOROAD_PHOTO_QUALITY", 85))
+PHOTO_FORMAT = os.environ.get("ECOROAD_PHOTO_FORMAT", "JPEG").upper()  # JPEG or WEBP
+
+
+@timing.timed("image.compress")
+def compress_photo(blob, max_dimension=MAX_DIMENSION, quality=QUALITY, fmt=PHOTO_FORMAT):
+    # decode any supported photo, fix the orientation, shrink it to fit
+    # max_dimension and re-encode it without metadata.
+    # Returns (bytes, width, height).
+    from PIL import Image, ImageOps, features
+
+    if fmt == "WEBP" and not features.check("webp"):
+        fmt = "JPEG"  # Pillow built without libwebp
+    image = Image.open(BytesIO(bytes(blob)))
+    image.draft("RGB", (max_dimension, max_dimension))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((max_dimension, max_dimension))
+    buffered = BytesIO()
+    if fmt == "WEBP":
+        image.save(buffered, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffered, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffered.getvalue(), image.width, image.height
+
+
+def normalize_image(blob, max_dimension=MAX_DIMENSION, quality=QUALITY, fmt=PHOTO_FORMAT):
+    # compress_photo, bytes only
+    return compress_photo(blob, max_dimension, quality, fmt)[0]
+
+
+def image_size(blob):
+    # (width, height) from the image header, without decoding the pixels;
+    # (None, None) when it is not an image
+    from PIL import Image
+
+    try:
+        return Image.open(BytesIO(bytes(blob))).size
+    except Exception:
+        return None, None
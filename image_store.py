@@ -0,0 +1,86 @@
+import hashlib
+import mmap
+import os
+import tempfile
+
+# Content addressed store for report photos.
+#
+# A photo is saved once under the sha256 of its bytes,
+#     images/<first 2 hex chars>/<sha256>.<ext>
+# and that relative path is the reference kept in user_data.img_name.
+# The same photo sent twice is only stored once, two reports from the
+# same spot no longer overwrite each other, and the database only holds
+# the short reference instead of the bytes.
+#
+# Reads map the file into memory instead of copying it through Python.
+
+STORE_DIR = "images"
+
+_EXTENSIONS = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF8", ".gif"),
+)
+
+
+def _extension(data):
+    head = bytes(data[:12])
+    for magic, ext in _EXTENSIONS:
+        if head.startswith(magic):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return ".bin"
+
+
+def ref_for(data):
+    # the reference data would be stored under, without storing it
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{STORE_DIR}/{digest[:2]}/{digest}{_extension(data)}"
+
+
+def put(data):
+    # store the bytes (if not already there) and return their reference
+    ref = ref_for(data)
+    if os.path.exists(ref):
+        return ref
+    folder = os.path.dirname(ref)
+    os.makedirs(folder, exist_ok=True)
+    # write to a temp file and rename, so readers never see half a photo and
+    # concurrent writers of the same photo just replace it with itself
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, ref)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return ref
+
+
+def is_stored(ref):
+    return bool(ref) and ref.startswith(STORE_DIR + "/") and os.path.exists(ref)
+
+
+def read(ref):
+    # read only memory map of a stored photo (a bytes-like object);
+    # None when it is not in the store
+    if not is_stored(ref):
+        return None
+    with open(ref, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_bytes(ref):
+    data = read(ref)
+    if data is None:
+        return None
+    try:
+        return bytes(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
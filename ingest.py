@@ -0,0 +1,203 @@
+import argparse
+import base64
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import data_storage
+import image_processing
+import location_raj
+import proc_pool
+
+# Bulk loader for historical survey data.
+#
+#     python ingest.py surveys.jsonl [--batch 500] [--geocode-workers 4] [--image-workers 4]
+#
+# Input is JSONL or CSV (picked by the file extension), one report per record:
+#     email, ph_no, lat, long (or lon), breadth, length, height   (dimensions in m)
+#     photo          path of the photo, relative to the input file (optional)
+#     photo_base64   the photo itself, instead of photo (optional)
+#     display_name, city, state, postcode, country
+#                    address, optional; records without a state are reverse
+#                    geocoded (through the location_raj cache and rate limit)
+#
+# The file is streamed batch by batch. For each batch the addresses are
+# looked up by a bounded thread pool, photos are normalized and their
+# thumbnails made in a process pool, and the batch is stored with one
+# data_storage.insert_many transaction. The number of records done is
+# written to the ingest_checkpoint table in that same transaction, so an
+# interrupted run picks up exactly where it stopped. Records that fail are
+# written to <input>.errors.jsonl and skipped.
+# The photo processes are started through proc_pool, not forked from
+# this process and its geocoder threads.
+
+
+def read_records(path):
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            yield from csv.DictReader(f)
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        yield e  # unreadable line, ingest() sends it to the errors file
+
+
+def _number(value, default=0.0):
+    return float(value) if value not in (None, "") else default
+
+
+def _load_photo(record, base_dir):
+    if record.get("photo_base64"):
+        return base64.b64decode(record["photo_base64"])
+    if record.get("photo"):
+        with open(os.path.join(base_dir, record["photo"]), "rb") as f:
+            return f.read()
+    return None
+
+
+def _address(record):
+    lat = _number(record.get("lat"))
+    long = _number(record.get("long", record.get("lon")))
+    if record.get("state"):
+        # already known, shaped like a Nominatim answer for insert_data
+        return {
+            "display_name": record.get("display_name") or ", ".join(
+                v for v in (record.get("city"), record.get("state"), record.get("country")) if v),
+            "lat": lat,
+            "lon": long,
+            "address": {"city": record.get("city", ""), "county": "", "state": record["state"],
+                        "postcode": record.get("postcode", ""), "country": record.get("country", "")},
+        }
+    return location_raj.reverse_location(lat, long)
+
+
+def _normalize(photo):
+    # runs in the process pool: (photo bytes, (thumb, width, height)), all the
+    # decoding the report needs, so insert_many does not decode it again
+    if photo is None:
+        return None, ("", None, None)
+    photo, width, height = image_processing.compress_photo(photo)
+    try:
+        thumb = image_processing.make_thumbnail(photo)
+    except Exception:
+        thumb = ""
+    return photo, (thumb, width, height)
+
+
+def _create_checkpoints(conn):
+    conn.execute("create table if not exists ingest_checkpoint (path TEXT PRIMARY KEY, done INTEGER NOT NULL)")
+
+
+def _save_checkpoint(key, done):
+    def save(conn):
+        conn.execute("insert or replace into ingest_checkpoint values (?, ?)", (key, done))
+    return save
+
+
+def _load_checkpoint(key, legacy):
+    # records already stored from this file; runs from before the table
+    # existed kept the count in <input>.checkpoint
+    data_storage.write(_create_checkpoints)
+    row = data_storage.connect().execute("select done from ingest_checkpoint where path = ?", (key,)).fetchone()
+    if row is not None:
+        return row[0]
+    if os.path.exists(legacy):
+        with open(legacy) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def ingest(path, batch=500, geocode_workers=4, image_workers=4, restart=False):
+    key = os.path.abspath(path)
+    errors_path = path + ".errors.jsonl"
+    base_dir = os.path.dirname(key)
+
+    done = 0 if restart else _load_checkpoint(key, path + ".checkpoint")
+    if done:
+        print(f"resuming after {done} records")
+
+    records = islice(read_records(path), done, None)
+    stored = failed = 0
+    start = time.time()
+    with ThreadPoolExecutor(geocode_workers) as geocoder, \
+            ProcessPoolExecutor(image_workers, mp_context=proc_pool.context()) as imager, \
+            open(errors_path, "a", encoding="utf-8") as errors:
+        while True:
+            lines = list(islice(records, batch))
+            if not lines:
+                break
+
+            # a bad record (unreadable line, missing photo, broken base64)
+            # only fails itself, never the batch
+            chunk = []
+            for r in lines:
+                if isinstance(r, Exception):
+                    failed += 1
+                    errors.write(json.dumps({"record": getattr(r, "doc", None), "error": repr(r)}) + "\n")
+                else:
+                    chunk.append(r)
+
+            addresses = [geocoder.submit(_address, r) for r in chunk]
+            photos = []
+            for r in chunk:
+                try:
+                    photos.append(imager.submit(_normalize, _load_photo(r, base_dir)))
+                except Exception as e:
+                    photos.append(e)
+
+            reports, previews, good = [], [], []
+            for record, address, photo in zip(chunk, addresses, photos):
+                try:
+                    if isinstance(photo, Exception):
+                        raise photo
+                    blob, preview = photo.result()
+                    reports.append((record.get("email", ""), record.get("ph_no", ""), address.result(),
+                                    None, blob, _number(record.get("breadth")),
+                                    _number(record.get("height")), _number(record.get("length"))))
+                    previews.append(preview)
+                    good.append(record)
+                except Exception as e:
+                    failed += 1
+                    errors.write(json.dumps({"record": record, "error": repr(e)}, default=str) + "\n")
+
+            # the checkpoint is committed with the reports, a crash can lose
+            # neither one without the other
+            done += len(lines)
+            if reports:
+                bad = []
+                data_storage.insert_many(reports, previews, then=_save_checkpoint(key, done), errors=bad)
+                for n, e in bad:
+                    failed += 1
+                    errors.write(json.dumps({"record": good[n], "error": repr(e)}, default=str) + "\n")
+                stored += len(reports) - len(bad)
+            else:
+                data_storage.write(_save_checkpoint(key, done))
+            errors.flush()
+
+            elapsed = time.time() - start
+            print(f"{done} records ({stored} stored, {failed} failed) "
+                  f"{(stored + failed) / elapsed:.1f} records/s", flush=True)
+    return stored, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load survey reports from JSONL/CSV into the EcoRoad database")
+    parser.add_argument("path", help="input .jsonl or .csv file")
+    parser.add_argument("--db", default=data_storage.db, help="database file (default: %(default)s)")
+    parser.add_argument("--batch", type=int, default=500, help="records per transaction")
+    parser.add_argument("--geocode-workers", type=int, default=4, help="concurrent address lookups")
+    parser.add_argument("--image-workers", type=int, default=os.cpu_count() or 1, help="processes for photo decoding")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the top")
+    args = parser.parse_args()
+    data_storage.db = args.db
+    stored, failed = ingest(args.path, args.batch, args.geocode_workers, args.image_workers, args.restart)
+    print(f"done, {stored} stored, {failed} failed")
+    sys.exit(1 if failed else 0)
@@ -1,7 +1,233 @@
-from geopy.geocoders import Nominatim
-geolocator = Nominatim(user_agent="my_geopy_app")
+import bisect
+import csv
+import json
+import math
+import os
+import threading
+import time
 
+import db_pool
+import geo
+import timing
 
+# Reverse geocoding with a persistent cache in front of it.
+#
+# Lookups are keyed by the coordinates rounded to PRECISION decimals
+# (5 decimals is about 1 m), kept for TTL seconds and the cache is trimmed
+# to MAX_ENTRIES by dropping the least recently used rows. Misses go to the
+# backend, by default Nominatim, at most one request per min_interval
+# seconds of that backend, and concurrent misses for the same key share
+# one request.
+#
+# The backend is anything with a reverse(lat, long) method returning a
+# Nominatim style "raw" dict; use set_backend() to swap in the offline
+# gazetteer (or a stub in tests and demos). Setting GEOCODE_GAZETTEER to a
+# CSV path makes the gazetteer the default.
+#
+# The backend and the cache connections (db_pool, one per thread) are
+# created on first use and shared by every session of the process.
+
+CACHE_DB = "geocode_cache.db"
+PRECISION = 5
+TTL = 30 * 24 * 3600
+MAX_ENTRIES = 100000
+
+
+class NominatimBackend:
+    min_interval = 1.0  # Nominatim usage policy: max 1 request per second
+
+    def __init__(self, user_agent="my_geopy_app"):
+        self.user_agent = user_agent
+        self._geolocator = None
+
+    def reverse(self, lat, long):
+        if self._geolocator is None:
+            from geopy.geocoders import Nominatim
+            self._geolocator = Nominatim(user_agent=self.user_agent)
+        location = self._geolocator.reverse(f"{lat},{long}")
+        return location.raw
+
+
+class GazetteerBackend:
+    # Offline backend: nearest place from a local CSV with the columns
+    # lat, lon, display_name, city, state, postcode, country.
+    # The places are kept sorted by latitude. A lookup walks outwards from
+    # the point's latitude and stops once the latitude difference alone is
+    # further than the nearest place found, so only a narrow band of places
+    # is ever measured.
+    KM_PER_DEGREE = math.pi * geo.EARTH_RADIUS_KM / 180
+
+    def __init__(self, path):
+        with open(path, newline="", encoding="utf-8") as f:
+            self.places = [dict(row, lat=float(row["lat"]), lon=float(row["lon"])) for row in csv.DictReader(f)]
+        if not self.places:
+            raise ValueError(f"no places in {path}")
+        self.places.sort(key=lambda p: p["lat"])
+        self._lats = [p["lat"] for p in self.places]
+
+    def nearest(self, lat, long):
+        lats = self._lats
+        lo = bisect.bisect_left(lats, lat) - 1
+        hi = lo + 1
+        best, best_km = None, math.inf
+        while lo >= 0 or hi < len(lats):
+            # the closer latitude of the two sides next
+            if hi >= len(lats) or (lo >= 0 and lat - lats[lo] <= lats[hi] - lat):
+                i, lo = lo, lo - 1
+            else:
+                i, hi = hi, hi + 1
+            if abs(lats[i] - lat) * self.KM_PER_DEGREE > best_km:
+                break  # everything further out is further away
+            place = self.places[i]
+            km = geo.haversine_km(lat, long, place["lat"], place["lon"])
+            if km < best_km:
+                best, best_km = place, km
+        return best
+
+    def reverse(self, lat, long):
+        place = self.nearest(float(lat), float(long))
+        return {
+            "display_name": place.get("display_name") or place.get("city", ""),
+            "lat": str(lat),
+            "lon": str(long),
+            "address": {
+                "city": place.get("city", ""),
+                "county": place.get("county", ""),
+                "state": place.get("state", ""),
+                "postcode": place.get("postcode", ""),
+                "country": place.get("country", ""),
+            },
+        }
+
+
+class StubBackend:
+    # Fixed answer for every point, for tests and offline demos
+    def __init__(self, city="Unknown", state="Unknown", postcode="000000", country="India"):
+        self.address = {"city": city, "county": "", "state": state, "postcode": postcode, "country": country}
+
+    def reverse(self, lat, long):
+        return {
+            "display_name": ", ".join(v for v in (self.address["city"], self.address["state"], self.address["country"]) if v),
+            "lat": str(lat),
+            "lon": str(long),
+            "address": dict(self.address),
+        }
+
+
+backend = None  # created on first lookup, see get_backend()
+_backend_lock = threading.Lock()
+
+_rate_lock = threading.Lock()
+_last_request = 0.0
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_backend():
+    # the process wide backend, built the first time it is needed so that
+    # importing this module loads neither geopy nor the gazetteer
+    global backend
+    if backend is None:
+        with _backend_lock:
+            if backend is None:
+                if os.environ.get("GEOCODE_GAZETTEER"):
+                    backend = GazetteerBackend(os.environ["GEOCODE_GAZETTEER"])
+                else:
+                    backend = NominatimBackend()
+    return backend
+
+
+def set_backend(new_backend):
+    global backend
+    backend = new_backend
+
+
+def _create_schema(conn):
+    # tables of the file, run once per process by db_pool.open_wal
+    conn.execute("""create table if not exists geocode_cache (
+        key TEXT PRIMARY KEY,
+        raw TEXT NOT NULL,
+        created REAL NOT NULL,
+        used REAL NOT NULL
+    )""")
+    conn.execute("create index if not exists geocode_cache_used on geocode_cache (used)")
+
+
+def _connect():
+    # this thread's connection to the cache
+    return db_pool.connection(CACHE_DB, lambda path: db_pool.open_wal(path, _create_schema))
+
+
+def _key(lat, long):
+    return f"{round(float(lat), PRECISION):.{PRECISION}f},{round(float(long), PRECISION):.{PRECISION}f}"
+
+
+def _cache_get(key):
+    now = time.time()
+    conn = _connect()
+    with conn:  # commit, or roll back so the shared connection stays clean
+        row = conn.execute("select raw, created from geocode_cache where key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > TTL:
+            return None
+        conn.execute("update geocode_cache set used = ? where key = ?", (now, key))
+        return json.loads(row[0])
+
+
+def _cache_put(key, raw):
+    now = time.time()
+    conn = _connect()
+    with conn:
+        conn.execute("insert or replace into geocode_cache values (?, ?, ?, ?)", (key, json.dumps(raw), now, now))
+        conn.execute("delete from geocode_cache where created < ?", (now - TTL,))
+        extra = conn.execute("select count(*) from geocode_cache").fetchone()[0] - MAX_ENTRIES
+        if extra > 0:
+            conn.execute("delete from geocode_cache where key in (select key from geocode_cache order by used limit ?)", (extra,))
+
+
+def _rate_limited(lat, long):
+    global _last_request
+    source = get_backend()
+    with _rate_lock:
+        wait = _last_request + getattr(source, "min_interval", 0) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_request = time.monotonic()
+    with timing.span("geocode.backend", backend=type(source).__name__):
+        return source.reverse(lat, long)
+
+
+@timing.timed("geocode.reverse")
 def reverse_location(lat,long):
-    location = geolocator.reverse(f"{lat},{long}")
-    return location.raw
\ No newline at end of file
+    key = _key(lat, long)
+    raw = _cache_get(key)
+    if raw is not None:
+        return raw
+
+    # the first thread to miss a key does the lookup, the others wait for it
+    with _inflight_lock:
+        pending = _inflight.get(key)
+        leader = pending is None
+        if leader:
+            pending = _inflight[key] = {"done": threading.Event()}
+    if not leader:
+        pending["done"].wait()
+        if "error" in pending:
+            raise pending["error"]
+        return pending["raw"]
+
+    try:
+        # a leader that finished between our cache miss and taking the slot
+        # has stored the answer already, do not ask the backend again
+        raw = _cache_get(key)
+        if raw is None:
+            raw = _rate_limited(lat, long)
+            _cache_put(key, raw)
+        pending["raw"] = raw
+        return raw
+    except Exception as e:
+        pending["error"] = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        pending["done"].set()
@@ -1,5 +1,4 @@
 import streamlit as st
-from PIL import Image
 
 # Set page configuration
 st.set_page_config(
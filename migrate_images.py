@@ -0,0 +1,100 @@
+import argparse
+import time
+
+import os
+
+import data_storage
+import image_processing
+import image_store
+
+# Moves photos stored inside user_data.img_blob into the content addressed
+# image store (see image_store.py). Each row gets the store reference in
+# img_name and its img_blob is cleared. Safe to stop and run again: only
+# rows that still have a blob are touched.
+#
+# With --compress, stored photos that were saved before compression at
+# capture existed (no recorded dimensions) are shrunk and re-encoded like
+# new ones (image_processing.compress_photo) and the old file is removed
+# once no report refers to it any more.
+#
+#     python migrate_images.py [--db user_database.db] [--batch 200] [--vacuum] [--compress]
+
+
+def migrate(batch=200, vacuum=False):
+    moved = 0
+    saved = 0
+    start = time.time()
+    while True:
+        rows = data_storage.connect().execute(
+            "select slno, img_blob from user_data where img_blob is not null limit ?", (batch,)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for slno, blob in rows:
+            updates.append((image_store.put(bytes(blob)), slno))
+            saved += len(blob)
+        data_storage.write(lambda conn: conn.executemany(
+            "update user_data set img_name = ?, img_blob = null where slno = ?", updates))
+        moved += len(rows)
+        print(f"moved {moved} photos ({saved / 1e6:.1f} MB) in {time.time() - start:.1f}s")
+    if vacuum and moved:
+        # give the freed pages back to the file system
+        conn = data_storage.connect()
+        conn.execute("pragma wal_checkpoint(truncate)")
+        conn.execute("vacuum")
+    return moved
+
+
+def compress(batch=200):
+    done = 0
+    before = after = 0
+    last = 0
+    start = time.time()
+    while True:
+        rows = data_storage.connect().execute(
+            """select slno, img_name from user_data
+               where img_width is null and img_blob is null and slno > ? order by slno limit ?""",
+            (last, batch)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        updates, old_refs = [], set()
+        for slno, ref in rows:
+            data = image_store.read_bytes(ref)
+            if data is None:
+                continue
+            try:
+                small, width, height = image_processing.compress_photo(data)
+            except OSError:
+                continue  # not an image, leave it alone
+            new_ref = image_store.put(small)
+            updates.append((new_ref, width, height, slno))
+            if new_ref != ref:
+                old_refs.add(ref)
+            before += len(data)
+            after += len(small)
+        data_storage.write(lambda conn: conn.executemany(
+            "update user_data set img_name = ?, img_width = ?, img_height = ? where slno = ?", updates))
+        # the same photo can belong to several reports, keep it while any does
+        conn = data_storage.connect()
+        for ref in old_refs:
+            if conn.execute("select 1 from user_data where img_name = ? limit 1", (ref,)).fetchone() is None \
+                    and image_store.is_stored(ref):
+                os.remove(ref)
+        done += len(updates)
+        print(f"compressed {done} photos ({before / 1e6:.1f} MB -> {after / 1e6:.1f} MB) "
+              f"in {time.time() - start:.1f}s")
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move report photos out of the database into the image store")
+    parser.add_argument("--db", default=data_storage.db, help="database file (default: %(default)s)")
+    parser.add_argument("--batch", type=int, default=200, help="rows per transaction")
+    parser.add_argument("--vacuum", action="store_true", help="compact the database afterwards")
+    parser.add_argument("--compress", action="store_true", help="also shrink and re-encode photos stored uncompressed")
+    args = parser.parse_args()
+    data_storage.db = args.db
+    print(f"done, {migrate(args.batch, args.vacuum)} photos moved")
+    if args.compress:
+        print(f"done, {compress(args.batch)} photos compressed")
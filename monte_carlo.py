@@ -0,0 +1,196 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import proc_pool
+import simulation
+import timing
+
+# Cost distributions over many random pothole scenarios.
+#
+#     summary = monte_carlo.run(10000, num_potholes=5, depth=(0.5, 1.5))
+#     summary["selling_price"]["p90"]
+#
+# Every scenario draws new pothole centers, depths and widths (and, when
+# given as ranges, new selling / manufacturing rates) and is priced with
+# the closed form volume and max depth from simulation.volume_terms, so no
+# surface is ever built. Scenarios are evaluated a batch at a time as
+# stacked (batch, potholes) arrays; with workers > 1 the batches are spread
+# over a process pool.
+#
+# Results are folded into one StreamingStats per metric as the batches come
+# in: exact count, mean, std, min and max, plus a fixed size uniform sample
+# for percentiles and histograms. Memory stays the same however many
+# scenarios are run.
+#
+# The process pool is created once per process and reused by every run. Its
+# workers are started through proc_pool, never forked from the Streamlit
+# server.
+# max_scenarios() tells interactive callers how many scenarios fit in
+# WORK_BUDGET.
+
+METRICS = ("volume", "max_depth", "selling_price", "manufacturing_price", "profit", "margin")
+SAMPLE_SIZE = 20000
+QUANTILES = (5, 25, 50, 75, 95)
+WORK_BUDGET = 3e8  # pothole x grid point evaluations, about 10 s on one core
+
+_pool = None  # (executor, workers)
+_pool_lock = threading.Lock()
+
+
+class StreamingStats:
+    # running moments (Chan et al. batch update) and a reservoir sample
+
+    def __init__(self, sample_size=SAMPLE_SIZE, seed=0):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sample = np.empty(sample_size)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        n = len(values)
+        if not n:
+            return
+        mean = values.mean()
+        total = self.count + n
+        delta = mean - self.mean
+        self.m2 += ((values - mean) ** 2).sum() + delta ** 2 * self.count * n / total
+        self.mean += delta * n / total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        # reservoir sampling (algorithm R), vectorised over the batch
+        size = len(self.sample)
+        fill = max(0, min(n, size - self.count))
+        self.sample[self.count:self.count + fill] = values[:fill]
+        if fill < n:
+            seen = np.arange(self.count + fill, total) + 1
+            slots = (self._rng.random(n - fill) * seen).astype(np.int64)
+            keep = slots < size
+            # later values win on repeated slots, as in the sequential version
+            self.sample[slots[keep]] = values[fill:][keep]
+        self.count = total
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / self.count)) if self.count else 0.0
+
+    def values(self):
+        return self.sample[:min(self.count, len(self.sample))]
+
+    def percentiles(self, q=QUANTILES):
+        values = self.values()
+        return dict(zip(q, np.percentile(values, q))) if len(values) else {}
+
+    def histogram(self, bins=40):
+        return np.histogram(self.values(), bins=bins)
+
+    def summary(self):
+        return {"count": self.count, "mean": float(self.mean), "std": self.std,
+                "min": float(self.min), "max": float(self.max),
+                **{f"p{q}": float(v) for q, v in self.percentiles().items()}}
+
+
+def _draw(rng, n, value):
+    # value is a number or a (low, high) range to draw from
+    if np.ndim(value):
+        return rng.uniform(value[0], value[1], n)
+    return np.full(n, float(value))
+
+
+def _batch(args):
+    # price one batch of scenarios; runs in the pool workers too
+    seed, count, num_potholes, grid_size, depth, width, selling, manu, method = args
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-3*10, 3*10, (count, num_potholes, 2))
+    depths = rng.uniform(depth[0], depth[1], (count, num_potholes))
+    widths = rng.uniform(width[0], width[1], (count, num_potholes))
+    volume, _ = simulation.volume_terms(centers, depths, widths, grid_size, method)
+    max_depth = simulation.smoothed_max_depth(centers, depths, widths, grid_size)
+
+    # same rate model as simulation.price_estimate, unrounded and per scenario
+    extent = 2 * simulation.GRID_EXTENT
+    cuboid_m3 = max_depth * 0.01 * extent * 0.01 * extent * 0.01
+    sp = simulation.fill_cost(cuboid_m3, _draw(rng, count, selling))
+    mp = simulation.fill_cost(cuboid_m3, _draw(rng, count, manu))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        margin = np.where(sp > 0, (sp - mp) / sp * 100, 0.0)
+    return {"volume": volume, "max_depth": max_depth, "selling_price": sp,
+            "manufacturing_price": mp, "profit": sp - mp, "margin": margin}
+
+
+def batch_size(num_potholes, grid_size, method="grid"):
+    # scenarios per batch so the largest temporary array stays within
+    # simulation.BATCH_ELEMENTS
+    # (the profiles of volume_terms and smoothed_max_depth are potholes x at
+    # most grid_size, whatever the method)
+    per_scenario = num_potholes * grid_size
+    return max(1, simulation.BATCH_ELEMENTS // per_scenario)
+
+
+def max_scenarios(num_potholes, grid_size, budget=WORK_BUDGET):
+    # how many scenarios of this size a run can price within budget
+    return max(1, int(budget // (num_potholes * grid_size)))
+
+
+def _executor(workers):
+    # the shared process pool, (re)created when it is missing, too small or broken
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool[1] < workers:
+            if _pool is not None:
+                _pool[0].shutdown(wait=False)
+            _pool = (ProcessPoolExecutor(workers, mp_context=proc_pool.context()), workers)
+        return _pool[0]
+
+
+def _drop_executor(executor):
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool[0] is executor:
+            _pool = None
+    executor.shutdown(wait=False)
+
+
+@timing.timed("simulation.monte_carlo")
+def run(scenarios=10000, num_potholes=5, grid_size=100, depth=(0.5, 1.5), width=(8, 15),
+        selling=40, manu=27, method="grid", seed=50, workers=1, progress=None):
+    # {metric: StreamingStats} over `scenarios` random scenes; selling and
+    # manu are rates in thousands of rs per m3, a number or a (low, high)
+    # range. progress(done, total) is called after every batch.
+    step = batch_size(num_potholes, grid_size, method)
+    sizes = [min(step, scenarios - s) for s in range(0, scenarios, step)]
+    # one independent stream per batch, so results do not depend on workers
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(sd, n, num_potholes, grid_size, depth, width, selling, manu, method) for sd, n in zip(seeds, sizes)]
+
+    stats = {name: StreamingStats(seed=seed) for name in METRICS}
+    done = 0
+
+    def fold(result, n):
+        nonlocal done
+        for name in METRICS:
+            stats[name].update(result[name])
+        done += n
+        if progress:
+            progress(done, scenarios)
+
+    if workers > 1 and len(jobs) > 1:
+        pool = _executor(min(workers, os.cpu_count() or 1))
+        try:
+            for result, n in zip(pool.map(_batch, jobs), sizes):
+                fold(result, n)
+        except BrokenProcessPool:
+            _drop_executor(pool)  # a worker died, the next run starts a new pool
+            raise
+    else:
+        for job, n in zip(jobs, sizes):
+            fold(_batch(job), n)
+    return stats
@@ -1,114 +1,158 @@
+import os
+
 import numpy as np
-import matplotlib.pyplot as plt
 import streamlit as st
-from scipy.ndimage import gaussian_filter
-
-def generate_pothole_simulation(grid_size=100, num_potholes=5,selling_slider=1,manu_slider=1):
-    # Create the grid
-
-
-    x = np.linspace(-25, 25, grid_size)
-    y = np.linspace(-25, 25, grid_size)
-    X, Y = np.meshgrid(x, y)
-
-    # Function to create multiple potholes
-    def multi_pothole(X, Y, centers, depths, widths):
-        Z_multi = np.zeros_like(X)
-        for (cx, cy, depth, width) in zip(centers[:, 0], centers[:, 1], depths, widths):
-            Z_multi += -np.exp(-((X - cx)**2 + (Y - cy)**2) / (2 * width**2)) * depth
-        return Z_multi
-
-    # Define random pothole centers, depths, and widths
-    np.random.seed(50)  # Use system time for randomness
-    centers = np.random.uniform(-3*10, 3*10, (num_potholes, 2))  # Random locations
-    depths = np.random.uniform(1, 1, num_potholes)  # Random depths
-    widths = np.random.uniform(0.8*10, 1.5*10, num_potholes)  # Random width variations
-
-    # Generate multiple potholes
-    Z_multi_uneven = multi_pothole(X, Y, centers, depths, widths)
-
-    # Add depth-only noise for an uneven bottom
-    depth_noise_multi = (np.random.rand(*X.shape) - 0.5) * 0.8
-    Z_multi_uneven += depth_noise_multi * np.exp(-0.5 * (X**2 + Y**2))
-
-    # Ensure the road surface remains flat at the top
-    Z_multi_uneven = np.minimum(0, Z_multi_uneven)
-
-    # Apply Gaussian smoothing to the pothole bottoms
-    Z_multi_smoothed = gaussian_filter(Z_multi_uneven, sigma=2)
-
-    # Find the max dimensions
-    max_length = np.max(X) - np.min(X)  # X-axis range
-    max_height = np.max(Y) - np.min(Y)  # Y-axis range
-    max_depth = round(np.abs(np.min(Z_multi_smoothed)),2)  # Max depth
+import fill_estimate
+import monte_carlo
+import simulation
+import surface_render
+import timing
+
+timing.start_run()
+
+
+def estimate_pothole_costs(grid_size=100, num_potholes=5, selling_slider=1, manu_slider=1):
+    # Closed form volume, no surface is built, so it works for any scene size
+    est = simulation.estimate_volume(grid_size, num_potholes, seed=50)
+    price = simulation.price_estimate(est["max_depth"], est["max_height"], est["max_length"],
+                                      selling_slider, manu_slider)
+
+    st.title("Pothole Cost Estimate")
+    st.markdown(f"**Original Volume:** {est['volume_original']:.2f} &plusmn; {est['error_bound']:.2f} cm<sup>3</sup>",
+                unsafe_allow_html=True)
+    st.write(f"cuboid height : {est['max_height']}cm  length :{est['max_length']}cm  depth : ~{est['max_depth']}cm")
+    st.markdown(f"**cuboid for volume :** {price['cuboid']}cm<sup>3</sup>",unsafe_allow_html=True)
+    st.write(f"total cost of blocks (selling price) : {price['selling_price']} rs")
+    st.write(f"total cost of blocks (manufacturing price) : {price['manufacturing_price']} rs")
+    st.write(f"total profit : {price['profit']} rs")
+    st.write(f"profit margin : {price['margin']}%")
+
+
+def scenario_budget(grid_size, num_potholes, scenarios, depth, width, selling, manu):
+    # Distribution of costs over many random scenes instead of the single seeded one
+    import pandas as pd
+
+    st.title("Pothole Budget Range")
+    bar = st.progress(0.0)
+    stats = monte_carlo.run(scenarios, num_potholes, grid_size, depth=depth, width=width,
+                            selling=selling, manu=manu, workers=os.cpu_count() or 1,
+                            progress=lambda done, total: bar.progress(done / total))
+    bar.empty()
+
+    labels = {"volume": "Volume (cm3)", "max_depth": "Max depth (cm)", "selling_price": "Selling price (rs)",
+              "manufacturing_price": "Manufacturing price (rs)", "profit": "Profit (rs)", "margin": "Margin (%)"}
+    st.dataframe(pd.DataFrame({labels[name]: stats[name].summary() for name in monte_carlo.METRICS}).T.round(2),
+                 use_container_width=True)
+    metric = st.selectbox("Distribution", list(labels), format_func=labels.get)
+    counts, edges = stats[metric].histogram()
+    st.bar_chart(pd.DataFrame({"scenarios": counts}, index=np.round((edges[:-1] + edges[1:]) / 2, 2)))
+
+
+def reported_backlog(selling, manu):
+    # Fill and cost for every pending citizen report, from their own dimensions
+    import pandas as pd
+
+    st.title("Reported Pothole Backlog")
+    est = fill_estimate.backlog_estimate(selling, manu)
+    totals = est["totals"]
+    cols = st.columns(4)
+    cols[0].metric("Pending reports", f"{totals['reports']:,}")
+    cols[1].metric("Fill volume", f"{totals['volume']:,.2f} m³")
+    cols[2].metric("Blocks", f"{totals['blocks']:,}")
+    cols[3].metric("Profit margin", f"{totals['margin']}%")
+    st.write(f"total cost of blocks (selling price) : {round(totals['selling_price'], 2)} rs")
+    st.write(f"total cost of blocks (manufacturing price) : {round(totals['manufacturing_price'], 2)} rs")
+    st.write(f"total profit : {round(totals['profit'], 2)} rs")
+
+    # the largest jobs first
+    top = np.argsort(est["volume"])[::-1][:50]
+    st.dataframe(pd.DataFrame({name: est[name][top] for name in
+                               ("slno", "volume", "blocks", "selling_price", "manufacturing_price", "profit")}).round(3),
+                 use_container_width=True, hide_index=True)
+
+
+def generate_pothole_simulation(grid_size=100, num_potholes=5,selling_slider=1,manu_slider=1,
+                                max_vertices=surface_render.DEFAULT_MAX_VERTICES,interactive=False,low_memory=False):
+    # Surface, smoothing and volume only depend on the grid and pothole count,
+    # they come from the simulation cache so price changes skip all of it
+    sim = simulation.cached_surface(grid_size, num_potholes, seed=50, low_memory=low_memory)
+    max_length = sim["max_length"]
+    max_height = sim["max_height"]
+    max_depth = sim["max_depth"]
+    volume_original = sim["volume_original"]
+
+    price = simulation.price_estimate(max_depth, max_height, max_length, selling_slider, manu_slider)
 
-    # # Scale down
-    # scaled_length = max_length * scale_factor
-    # scaled_height = max_height * scale_factor
-    # scaled_depth = max_depth * scale_factor
-
-    # # Scale down the X and Y coordinates
-    # x_scaled = np.linspace(-scaled_length / 2, scaled_length / 2, grid_size)
-    # y_scaled = np.linspace(-scaled_height / 2, scaled_height / 2, grid_size)
-    # X_scaled, Y_scaled = np.meshgrid(x_scaled, y_scaled)
-
-    # Scale down the pothole depths
-    # Z_scaled = Z_multi_smoothed * (scaled_depth / max_depth)
-
-    # Calculate volumes
-    dx_original = np.abs(x[1] - x[0])
-    dy_original = np.abs(y[1] - y[0])
-    volume_original = np.sum(np.abs(Z_multi_uneven) * dx_original * dy_original)
-
-    cuboid=round(max_depth*max_height*max_length,4)
     # Streamlit UI
-    volume=round(max_depth*max_height*max_length,3)
     st.title("3D Pothole Simulation")
     st.markdown(f"**Original Volume:** {volume_original:.2f} cm<sup>3</sup>",unsafe_allow_html=True)
     st.write(f"cuboid height : {max_height}cm  length :{max_length}cm  depth : {max_depth}cm")
 
-    st.markdown(f"**cuboid for volume :** {max_depth*max_height*max_length}cm<sup>3</sup>",unsafe_allow_html=True)
-    sp=round((max_depth*0.01)*max_height*0.01*max_length*0.01*selling_slider*1000,2)
-    mp=round((max_depth*0.01)*max_height*0.01*max_length*0.01*manu_slider*1000,2)
+    st.markdown(f"**cuboid for volume :** {price['cuboid']}cm<sup>3</sup>",unsafe_allow_html=True)
+    sp=price["selling_price"]
+    mp=price["manufacturing_price"]
 
     st.write(f"total cost of blocks (selling price) : {sp} rs")
     st.write(f"total cost of blocks (manufacturing price) : {mp} rs")
-    st.write(f"total profit : {round(sp-mp,2)} rs")
-    st.write(f"profit margin : {round(((sp-mp)/sp)*100,2)}%")
-
-
-
+    st.write(f"total profit : {price['profit']} rs")
+    st.write(f"profit margin : {price['margin']}%")
 
     # st.write(f"**cuboid waste :** {round(((cuboid - volume_scaled) / cuboid),2)} cubic units")
     # st.write(f"**cuboid waste :** {round(((cuboid - volume_scaled) / cuboid) * 100,2)} %")
 
-
-    # Create a side-by-side comparison plot
-    fig, axes = plt.subplots(1, 2, figsize=(12, 5), subplot_kw={"projection": "3d"})
-
-    # Plot Original Rough Pothole Surface
-    ax1 = axes[0]
-    ax1.plot_surface(X, Y, Z_multi_uneven, cmap='gray', edgecolor='k')
-    ax1.set_title(f"Original Rough Potholes\nLength: {max_length:.2f}, Height: {max_height:.2f}, Depth: {max_depth:.2f}\nVolume: {volume_original:.2f} cubic units")
-    ax1.set_xlabel("X-axis")
-    ax1.set_ylabel("Y-axis")
-    ax1.set_zlabel("Depth")
-
-    # Plot Scaled-Down Smoothed Pothole Surface
-    # ax2 = axes[1]
-    # ax2.plot_surface(X_scaled, Y_scaled, Z_scaled, cmap='gray', edgecolor='k')
-    # ax2.set_title(f"Scaled-Down ({scale_factor*100:.0f}%) Smoothed Potholes\nLength: {scaled_length:.2f}, Height: {scaled_height:.2f}, Depth: {scaled_depth:.2f}\nVolume: {volume_scaled:.2f} cubic units")
-    # ax2.set_xlabel("X-axis")
-    # ax2.set_ylabel("Y-axis")
-    # ax2.set_zlabel("Depth")
+    # The plot is drawn from a decimated copy of the surface (volumes above
+    # come from the full grid), rendered once per surface and detail level
+    # and kept with the surface in the cache
+    if interactive:
+        st.pydeck_chart(surface_render.surface_deck(sim, max_vertices))
+        return
+    png_key = f"png_{max_vertices}"
+    if png_key not in sim:
+        simulation.cache_extra(sim, png_key, surface_render.render_surface_png(sim, max_vertices))
 
     # Show the plots in Streamlit
-    st.pyplot(fig)
+    st.image(sim[png_key])
 
 # Streamlit user inputs
-grid_size = st.slider("Grid Size", min_value=50, max_value=300, value=100, step=10)
-num_potholes = st.slider("Number of Potholes", min_value=1, max_value=300, value=5)
+mode = st.radio("Mode", ["Surface", "Fast volume estimate (no surface)", "Budget range (random scenarios)",
+                         "Reported backlog"], horizontal=True)
+fast = mode != "Surface"
+low_memory = not fast and st.checkbox("Low-memory mode (float32, for large grids)")
+# without a surface to build, much larger scenes are cheap
+budget = mode == "Budget range (random scenarios)"
+grid_size = st.slider("Grid Size", min_value=50, max_value=5000 if fast else 2000 if low_memory else 300,
+                      value=100, step=10)
+# every scenario of the budget range is priced on its own, so fewer potholes there
+num_potholes = st.slider("Number of Potholes", min_value=1, max_value=1000 if budget else 10000 if fast else 300,
+                         value=5)
 selling_slider = st.slider("Cost Slider in thousands/m3 (selling price)", min_value=1, max_value=100, value=40)
 manu_slider = st.slider("Cost Slider in thousands/m3 (manufacturing price)", min_value=1, max_value=100, value=27)
-
-generate_pothole_simulation(grid_size, num_potholes,selling_slider,manu_slider)
+if mode == "Reported backlog":
+    reported_backlog(selling_slider, manu_slider)
+    timing.finish_run("company")
+    st.stop()
+if budget:
+    # the run blocks this page, keep it within monte_carlo.WORK_BUDGET
+    limit = monte_carlo.max_scenarios(num_potholes, grid_size)
+    options = [i for i in (1000, 5000, 10000, 50000, 100000) if i <= limit] or [limit]
+    scenarios = st.select_slider("Scenarios", options=options, value=min(10000, options[-1]))
+    if limit < 100000:
+        st.caption(f"At most {limit:,} scenarios for {num_potholes} potholes on a {grid_size} grid.")
+    depth = st.slider("Pothole depth range (cm)", min_value=0.1, max_value=5.0, value=(0.5, 1.5))
+    width = st.slider("Pothole width range (cm)", min_value=1.0, max_value=30.0, value=(8.0, 15.0))
+    spread = st.slider("Rate uncertainty (± %)", min_value=0, max_value=50, value=10)
+    rates = [(r * (1 - spread / 100), r * (1 + spread / 100)) for r in (selling_slider, manu_slider)]
+    scenario_budget(grid_size, num_potholes, scenarios, depth, width, *rates)
+    timing.finish_run("company")
+    st.stop()
+if fast:
+    estimate_pothole_costs(grid_size, num_potholes, selling_slider, manu_slider)
+    timing.finish_run("company")
+    st.stop()
+
+plot_detail = st.select_slider("Plot detail (vertices)", options=[50*50, 100*100, 150*150, 300*300], value=surface_render.DEFAULT_MAX_VERTICES)
+interactive = st.checkbox("Interactive 3D view")
+
+generate_pothole_simulation(grid_size, num_potholes,selling_slider,manu_slider,plot_detail,interactive,low_memory)
+
+timing.finish_run("company")
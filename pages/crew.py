@@ -0,0 +1,74 @@
+import pandas as pd
+import streamlit as st
+import data_storage
+import timing
+import work_queue
+
+timing.start_run()
+
+# -------------------- Page Config --------------------
+st.set_page_config(
+    page_title="🚧 EcoRoad - Repair Queue",
+    page_icon="🚧",
+    layout="wide"
+)
+
+# jobs a crew took and never finished go back to the pool now and then
+@st.cache_data(ttl=3600)
+def release_stale():
+    return len(work_queue.release_stale())
+
+release_stale()
+
+st.title("🚧 Repair Queue")
+col1, col2, col3 = st.columns(3)
+crew = col1.text_input("Crew name").strip()
+state = col2.text_input("State (optional)").strip() or None
+city = col3.text_input("City (optional)").strip() or None
+
+counts = {status: count for status, count, _ in data_storage.report_summary("status")}
+cols = st.columns(len(work_queue.STATUS_NAMES))
+for col, (status, name) in zip(cols, work_queue.STATUS_NAMES.items()):
+    col.metric(name, f"{counts.get(status, 0):,}")
+
+# -------------------- Crew Jobs --------------------
+# the biggest verified jobs first; claiming is atomic, two crews pressing the
+# button at the same time get different jobs
+st.subheader("🛠️ My jobs")
+if not crew:
+    st.info("Enter your crew name to take and close jobs.")
+else:
+    count = st.number_input("Jobs to take", min_value=1, max_value=20, value=3)
+    if st.button("Take next jobs"):
+        taken = work_queue.claim(crew, count, state=state, city=city)
+        st.success(f"Took {len(taken)} job(s)." if taken else "No verified jobs left here.")
+
+    jobs = work_queue.crew_jobs(crew)
+    if jobs:
+        st.dataframe(pd.DataFrame(jobs).set_index("slno"), use_container_width=True)
+        chosen = st.multiselect("Jobs", [job["slno"] for job in jobs])
+        done, back = st.columns(2)
+        if done.button("Mark filled", disabled=not chosen):
+            work_queue.transition(chosen, work_queue.FILLED, crew=crew)
+            st.rerun()
+        if back.button("Release", disabled=not chosen):
+            work_queue.transition(chosen, work_queue.VERIFIED, crew=crew)
+            st.rerun()
+
+# -------------------- Verification --------------------
+st.subheader("✅ Waiting for verification")
+submitted = work_queue.next_jobs(50, status=work_queue.SUBMITTED, state=state, city=city)
+if submitted:
+    st.dataframe(pd.DataFrame(submitted).set_index("slno"), use_container_width=True)
+    chosen = st.multiselect("Reports to verify", [job["slno"] for job in submitted])
+    if st.button("Verify", disabled=not chosen):
+        work_queue.verify(chosen)
+        st.rerun()
+else:
+    st.write("Nothing waiting.")
+
+st.subheader("📋 Next verified jobs")
+st.dataframe(pd.DataFrame(work_queue.next_jobs(20, state=state, city=city), columns=work_queue.FEED_COLUMNS),
+             use_container_width=True, hide_index=True)
+
+timing.finish_run("crew")
@@ -1,11 +1,14 @@
-import base64
-from io import BytesIO
 import numpy
 import streamlit as st
 import data_storage
+import dashboard_data
 import pandas as pd
 import pydeck as pdk
-from PIL import Image
+import geo
+import timing
+import work_queue
+
+timing.start_run()
 
 # -------------------- Page Config --------------------
 st.set_page_config(
@@ -41,81 +44,112 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # -------------------- Load Data --------------------
-data = data_storage.get_data("email, ph_no, address, lat, long, postcode, city, state, country, breadth, length, height, status, img_blob")
-
-# Coordinates for map
-cord = [(i[3], i[4]) for i in data]
-
-# Convert blob to base64 image
-def blob_to_base64(blob):
-    image = Image.open(BytesIO(blob))
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
-
-# Convert to DataFrame
-df_coords = pd.DataFrame(cord, columns=["lat", "lon"])
-df_data = pd.DataFrame(data, columns=[
-    "email",
-    "ph_no",
-    "address",
-    "lat",
-    "long",
-    "postcode",
-    "city",
-    "state",
-    "country",
-    "breadth",
-    "length",
-    "height",
-    "status",
-    "image",
-])
-df_data.index = numpy.arange(1, len(df_data)+1)
-
-# Convert image column
-df_data["image"] = df_data["image"].apply(lambda x: f'data:image/png;base64,{blob_to_base64(x)}')
-
-# -------------------- Icon Layer Setup --------------------
-ICON_URL = "https://upload.wikimedia.org/wikipedia/commons/e/ed/Map_pin_icon.svg"
-icon_data = {
-    "url": ICON_URL,
-    "width": 128,
-    "height": 128,
-    "anchorY": 128
-}
-df_coords["icon"] = [icon_data] * len(df_coords)
+# reports stored before thumbnails existed get theirs once per process
+@st.cache_resource
+def backfill_thumbnails():
+    return data_storage.backfill_thumbnails()
+
+backfill_thumbnails()
+
+# -------------------- Viewport --------------------
+# only the reports inside the area being looked at are read, through the
+# spatial index in data_storage
+MAX_REPORTS = 5000
+
+@st.cache_data(ttl=300)
+def default_center():
+    return data_storage.coordinate_center() or (20.59, 78.96)  # center of India
+
+center = default_center()
+with st.sidebar:
+    st.markdown("**🧭 Map view**")
+    view_lat = st.number_input("Latitude", -90.0, 90.0, float(center[0]), format="%.4f")
+    view_lon = st.number_input("Longitude", -180.0, 180.0, float(center[1]), format="%.4f")
+    view_zoom = st.slider("Zoom", 1, 18, 6)
+
+# thumbnails are stored as ready data URIs, the full photos stay in the database.
+# The frames are cached per process and only pick up new or changed reports
+# on a rerun (see dashboard_data.report_view).
+bbox = geo.viewport_bbox(view_lat, view_lon, view_zoom)
+df_coords, df_data, complete = dashboard_data.report_view(bbox, limit=MAX_REPORTS)
 
 # -------------------- PyDeck Layer --------------------
-layer = pdk.Layer(
-    "IconLayer",
-    df_coords,
-    get_position=["lon", "lat"],
-    get_icon="icon",
-    get_size=20,
-    pickable=True
-)
+# Below PIN_ZOOM the map draws one marker per cluster cell (precomputed in
+# data_storage), so the payload depends on the screen, not on the number of
+# reports. Individual pins are only sent when zoomed in or when few remain.
+PIN_ZOOM = 13
+PIN_LIMIT = 500
+
+clusters = data_storage.get_clusters(view_zoom, *bbox)
+show_pins = view_zoom >= PIN_ZOOM or sum(i[2] for i in clusters) <= PIN_LIMIT
+
+if show_pins:
+    ICON_URL = "https://upload.wikimedia.org/wikipedia/commons/e/ed/Map_pin_icon.svg"
+    icon_data = {
+        "url": ICON_URL,
+        "width": 128,
+        "height": 128,
+        "anchorY": 128
+    }
+    df_coords = df_coords.assign(icon=[icon_data] * len(df_coords))  # the cached frame stays untouched
+    layers = [pdk.Layer(
+        "IconLayer",
+        df_coords,
+        get_position=["lon", "lat"],
+        get_icon="icon",
+        get_size=20,
+        pickable=True
+    )]
+    tooltip = {"text": "🧭 Latitude: {lat}\n🧭 Longitude: {lon}"}
+else:
+    df_clusters = pd.DataFrame(clusters, columns=["lat", "lon", "count", "volume"])
+    df_clusters["volume"] = df_clusters["volume"].round(2)
+    df_clusters["label"] = df_clusters["count"].astype(str)
+    df_clusters["radius"] = 12 + 4 * numpy.log2(df_clusters["count"])
+    layers = [
+        pdk.Layer(
+            "ScatterplotLayer",
+            df_clusters,
+            get_position=["lon", "lat"],
+            get_radius="radius",
+            radius_units="pixels",
+            get_fill_color=[46, 125, 50, 180],
+            pickable=True
+        ),
+        pdk.Layer(
+            "TextLayer",
+            df_clusters,
+            get_position=["lon", "lat"],
+            get_text="label",
+            get_size=14,
+            get_color=[255, 255, 255]
+        ),
+    ]
+    tooltip = {"text": "🕳️ Reports: {count}\n📐 Estimated damage: {volume} m³"}
 
 # -------------------- Map View --------------------
 view_state = pdk.ViewState(
-    latitude=df_coords["lat"].mean(),
-    longitude=df_coords["lon"].mean(),
-    zoom=6
+    latitude=view_lat,
+    longitude=view_lon,
+    zoom=view_zoom
 )
 
 deck_map = pdk.Deck(
-    layers=[layer],
+    layers=layers,
     initial_view_state=view_state,
     map_style="mapbox://styles/mapbox/streets-v11",
-    tooltip={"text": "🧭 Latitude: {lat}\n🧭 Longitude: {lon}"}
+    tooltip=tooltip
 )
 
 # -------------------- Display --------------------
 st.title("🗺️ EcoRoad Map Dashboard")
 st.markdown("Explore reported road damages on the map. Click pins for location info.")
+if not complete:
+    st.warning(f"Showing the first {MAX_REPORTS} reports in this area, zoom in to see the rest.")
 
 # Display Map
-st.pydeck_chart(deck_map)
+with timing.span("maps.pydeck_chart"):
+    st.pydeck_chart(deck_map)
 
 # -------------------- Info Section --------------------
 st.subheader("📍 Selected Location Details")
@@ -124,6 +158,26 @@ if "clicked_info" not in st.session_state:
 
 st.info(st.session_state.clicked_info)
 
+# -------------------- Summary --------------------
+# read from the report_stats table that data_storage keeps up to date, so
+# this does not depend on the number of reports
+STATUS_NAMES = work_queue.STATUS_NAMES
+
+st.subheader("📈 Report Summary")
+total = data_storage.report_summary(())
+by_status = data_storage.report_summary("status")
+col1, col2, col3 = st.columns(3)
+col1.metric("Total reports", total[0][0] or 0)
+col2.metric("Estimated damage", f"{(total[0][1] or 0):.2f} m³")
+col3.metric("Pending", sum(count for status, count, _ in by_status if status != work_queue.FILLED))
+with st.expander("📊 Reports by state and city"):
+    df_summary = pd.DataFrame(data_storage.report_summary(("state", "city")),
+                              columns=["state", "city", "reports", "volume (m³)"])
+    df_status = pd.DataFrame(by_status, columns=["status", "reports", "volume (m³)"])
+    df_status["status"] = df_status["status"].map(lambda i: STATUS_NAMES.get(i, i))
+    st.dataframe(df_status, use_container_width=True, hide_index=True)
+    st.dataframe(df_summary, use_container_width=True, hide_index=True)
+
 # -------------------- Data Table --------------------
 with st.expander("📊 Expand to View Full Reports Table"):
     st.dataframe(
@@ -136,7 +190,25 @@ with st.expander("📊 Expand to View Full Reports Table"):
         use_container_width=True
     )
 
+# -------------------- Single Report --------------------
+# the full size photo is only read from storage for the report being opened
+if len(df_data):
+    report_no = st.selectbox("🔎 Open report", df_data.index, index=None, placeholder="Choose a report number")
+    if report_no is not None:
+        report = df_data.loc[report_no]
+        st.markdown(f"**{report['address']}**")
+        st.write(f"📐 Breadth: {report['breadth']} m, Length: {report['length']} m, Depth: {report['height']} m")
+        blob = data_storage.get_image(int(report_no))
+        if blob:
+            size = data_storage.query(["img_width", "img_height"], slno=int(report_no))
+            caption = f"Report {report_no}"
+            if size and size[0][0]:
+                caption += f" ({size[0][0]}×{size[0][1]}, {len(blob) // 1024} KB)"
+            st.image(blob, caption=caption)
+
 # -------------------- Footer --------------------
 st.markdown("---")
 st.markdown("📌 *Data retrieved from EcoRoad Storage*")
 st.markdown("🌱 *Together, we pave the way for a sustainable future.*")
+
+timing.finish_run("maps")
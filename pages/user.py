@@ -1,9 +1,12 @@
 import streamlit as st
-import data_storage
 import location_raj
+import report_queue
+import timing
 from streamlit_js_eval import get_geolocation
 import re
 
+timing.start_run()
+
 # -------------------- Page Config --------------------
 st.set_page_config(
     page_title="🌱 EcoRoad - Report Road Damage",
@@ -38,6 +41,9 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# reports are geocoded, saved and stored by background workers
+report_queue.start_workers()
+
 # -------------------- Title --------------------
 st.title("🌿 EcoRoad - Road Filling Report")
 st.markdown("Help us build better, safer roads with your report. Powered by the community, built for sustainability.")
@@ -115,23 +121,13 @@ if submit:
 
         lat = location['latitude']
         long = location['longitude']
-        address = location_raj.reverse_location(lat, long)
-        pic_name = f"images/{lat}-{long}.jpg"
 
-        # Save image
-        a = picture.getbuffer()
-        with open(pic_name, "wb") as f:
-            f.write(a)
-
-        # Insert into database
-        data_storage.insert_data(email, ph_no, address, pic_name, a, breadth, height, length)
+        # Queue the report, geocoding and storage happen in the background
+        job_id = report_queue.submit(email, ph_no, lat, long, picture.getbuffer(), breadth, height, length)
+        st.session_state.setdefault("report_jobs", []).append(job_id)
 
         st.success(f"""
-        ✅ Report Submitted Successfully!
-
-        📍 Location: {address["display_name"]}
-
-        📷 Picture saved as `{pic_name}`
+        ✅ Report received! It is being processed (reference #{job_id}).
 
         📐 Dimensions (in meters):
         - Breadth: {breadth} m
@@ -139,6 +135,31 @@ if submit:
         - Depth: {height} m
         """)
 
+# -------------------- Submission Status --------------------
+STATUS_TEXT = {
+    "queued": "⏳ Waiting to be processed",
+    "geocoding": "📍 Looking up the address",
+    "saving": "💾 Saving the report",
+    "done": "✅ Stored",
+    "failed": "❌ Failed",
+}
+
+if st.session_state.get("report_jobs"):
+    with st.expander("📬 Your Submissions", expanded=True):
+        st.button("🔄 Refresh status")
+        for job_id in reversed(st.session_state.report_jobs):
+            job = report_queue.job_status(job_id)
+            if job is None:
+                continue
+            line = f"**#{job_id}** — {STATUS_TEXT.get(job['status'], job['status'])}"
+            if job["status"] == "done":
+                line += f"  \n📍 {job['address']}  \n📷 Picture saved as `{job['pic_name']}`"
+            elif job["status"] == "failed":
+                line += f"  \n{job['error']}"
+            st.markdown(line)
+
 # -------------------- Footer --------------------
 st.markdown("---")
 st.markdown("© 2025 EcoRoad Project | Made with ❤️ for a cleaner, greener tomorrow")
+
+timing.finish_run("user")
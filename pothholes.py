@@ -1,32 +1,27 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.ndimage import gaussian_filter
+import simulation
 
 def generate_pothole_simulation(grid_size=100, num_potholes=5, scale_factor=0.95):
+    import matplotlib.pyplot as plt
+
     # Create the grid
     x = np.linspace(-5, 5, grid_size)
     y = np.linspace(-5, 5, grid_size)
     X, Y = np.meshgrid(x, y)
 
-    # Function to create multiple potholes
-    def multi_pothole(X, Y, centers, depths, widths):
-        Z_multi = np.zeros_like(X)
-        for (cx, cy, depth, width) in zip(centers[:, 0], centers[:, 1], depths, widths):
-            Z_multi += -np.exp(-((X - cx)**2 + (Y - cy)**2) / (2 * width**2)) * depth
-        return Z_multi
-
     # Define random pothole centers, depths, and widths
     np.random.seed(None)  # Use system time for randomness
     centers = np.random.uniform(-3, 3, (num_potholes, 2))  # Random locations
     depths = np.random.uniform(1.5, 3.5, num_potholes)  # Random depths
     widths = np.random.uniform(0.8, 1.5, num_potholes)  # Random width variations
 
-    # Generate multiple potholes
-    Z_multi_uneven = multi_pothole(X, Y, centers, depths, widths)
+    # Generate multiple potholes (see simulation.py for the truncation tolerance)
+    Z_multi_uneven = simulation.pothole_surface(x, y, centers, depths, widths)
 
     # Add depth-only noise for an uneven bottom
     depth_noise_multi = (np.random.rand(*X.shape) - 0.5) * 0.8
-    Z_multi_uneven += depth_noise_multi * np.exp(-0.5 * (X**2 + Y**2))
+    Z_multi_uneven += depth_noise_multi * simulation.noise_envelope(x, y)
 
     # Ensure the road surface remains flat at the top
     Z_multi_uneven = np.minimum(0, Z_multi_uneven)
@@ -92,5 +87,7 @@ def generate_pothole_simulation(grid_size=100, num_potholes=5, scale_factor=0.95
     data=[round(volume_original,2), round(volume_scaled,2), round(cuboid,2),round(((cuboid - volume_scaled) / cuboid) * 100,2)]
 
 
-# Run the function with default parameters
-generate_pothole_simulation(60,100,0.95)
+# Run the function with default parameters (only when run as a script, so
+# importing this module no longer simulates and opens a plot window)
+if __name__ == "__main__":
+    generate_pothole_simulation(60,100,0.95)
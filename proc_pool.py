@@ -0,0 +1,15 @@
+import multiprocessing
+
+# Start method for the process pools (monte_carlo, ingest.py).
+#
+#     ProcessPoolExecutor(workers, mp_context=proc_pool.context())
+#
+# Workers are started by a fork server, or spawned where there is none,
+# never forked from the caller: the Streamlit server and the CLIs run
+# threads (sessions, geocoder pools) whose locks a forked child would
+# inherit in whatever state they happened to be.
+
+
+def context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
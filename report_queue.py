@@ -0,0 +1,171 @@
+import json
+import sqlite3 as sq
+import threading
+import time
+
+import data_storage
+import db_pool
+import image_processing
+import image_store
+import location_raj
+import timing
+
+# Background pipeline for submitted reports.
+#
+# The report form only calls submit(), which writes the raw report (form
+# fields, coordinates and photo bytes) to a durable SQLite queue and returns
+# the job id straight away. Worker threads then claim jobs one at a time,
+# reverse geocode, compress and save the photo and insert the report through
+# data_storage. Every step is written to the job's status so the page can
+# show progress:
+#
+#     queued -> geocoding -> saving -> done      (or failed, with the error)
+#
+# Jobs survive restarts: anything left half done by a dead process is put
+# back in the queue once it is older than STALE_AFTER seconds. The slno is
+# written to the job as soon as the report is stored, and a retried job that
+# already has one only finishes up, so retries never store a report twice.
+
+QUEUE_DB = "report_queue.db"
+WORKERS = 4
+POLL_INTERVAL = 0.5
+STALE_AFTER = 300
+MAX_ATTEMPTS = 3
+
+_workers = []
+_workers_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def _create_schema(conn):
+    # tables of the file, run once per process by db_pool.open_wal
+    conn.execute("""create table if not exists report_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT NOT NULL,
+        image BLOB,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        slno INTEGER,
+        created REAL NOT NULL,
+        updated REAL NOT NULL
+    )""")
+    conn.execute("create index if not exists report_queue_status on report_queue (status, id)")
+
+
+def _connect():
+    # this thread's connection to the queue (db_pool), reused across reruns
+    # (the status panel asks for every job on each one)
+    return db_pool.connection(QUEUE_DB, lambda path: db_pool.open_wal(path, _create_schema))
+
+
+@timing.timed("queue.submit")
+def submit(email, ph_no, lat, long, image, breadth, height, length):
+    # store the raw report and return its job id, nothing slow happens here
+    payload = json.dumps({"email": email, "ph_no": ph_no, "lat": lat, "long": long,
+                          "breadth": breadth, "height": height, "length": length})
+    now = time.time()
+    conn = _connect()
+    with conn:
+        job_id = conn.execute("insert into report_queue (payload, image, created, updated) values (?, ?, ?, ?)",
+                              (payload, bytes(image), now, now)).lastrowid
+    _wakeup.set()
+    return job_id
+
+
+def job_status(job_id):
+    # dict with status, error, slno and the stored address once geocoded
+    row = _connect().execute("select status, error, slno, payload from report_queue where id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    payload = json.loads(row[3])
+    return {"status": row[0], "error": row[1], "slno": row[2],
+            "address": payload.get("address", {}).get("display_name"), "pic_name": payload.get("pic_name")}
+
+
+def _set(conn, job_id, status, **fields):
+    sets = ", ".join(["status = ?", "updated = ?"] + [f"{k} = ?" for k in fields])
+    conn.execute(f"update report_queue set {sets} where id = ?", [status, time.time(), *fields.values(), job_id])
+    conn.commit()
+
+
+def _claim(conn):
+    # atomically move the oldest queued job to geocoding, None if there is none
+    now = time.time()
+    conn.execute("""update report_queue set status = 'queued'
+                    where status in ('geocoding', 'saving') and updated < ?""", (now - STALE_AFTER,))
+    row = conn.execute("""update report_queue set status = 'geocoding', attempts = attempts + 1, updated = ?
+                          where id = (select id from report_queue where status = 'queued' order by id limit 1)
+                          and status = 'queued'
+                          returning id, payload, image, attempts, slno""", (now,)).fetchone()
+    conn.commit()
+    return row
+
+
+@timing.timed("queue.process")
+def _process(conn, job_id, payload, image, slno=None):
+    if slno is not None:
+        # stored by an earlier attempt that failed afterwards, only finish it
+        _set(conn, job_id, "done", payload=json.dumps(payload), image=None, error=None)
+        return
+    lat, long = payload["lat"], payload["long"]
+    address = location_raj.reverse_location(lat, long)
+    payload["address"] = address
+    _set(conn, job_id, "saving", payload=json.dumps(payload))
+
+    # Shrink and re-encode the photo (no metadata) before it is stored. This
+    # runs on the worker threads, Pillow releases the GIL while it decodes and
+    # encodes, so the form never waits for it.
+    try:
+        image = image_processing.normalize_image(image)
+    except OSError:
+        pass  # not a photo Pillow can read, keep it as it came
+
+    # Save image (content addressed, the same photo is only stored once)
+    pic_name = image_store.put(image)
+    payload["pic_name"] = pic_name
+
+    # Insert into database, only the image reference goes into the row
+    slno = data_storage.insert_data(payload["email"], payload["ph_no"], address, pic_name, None,
+                                    payload["breadth"], payload["height"], payload["length"])
+    # recorded straight away, from here on a retry must not insert again
+    _set(conn, job_id, "saving", payload=json.dumps(payload), slno=slno)
+    # the photo is in the database now, the queue does not need its copy
+    _set(conn, job_id, "done", image=None, error=None)
+
+
+def run_once(conn=None):
+    # process one job, returns False when the queue is empty
+    conn = conn or _connect()
+    job = _claim(conn)
+    if job is None:
+        return False
+    job_id, payload, image, attempts, slno = job
+    try:
+        _process(conn, job_id, json.loads(payload), image, slno)
+    except Exception as e:
+        conn.rollback()
+        _set(conn, job_id, "failed" if attempts >= MAX_ATTEMPTS else "queued", error=repr(e))
+    return True
+
+
+def _worker():
+    conn = _connect()
+    while True:
+        try:
+            busy = run_once(conn)
+        except sq.Error:
+            conn.rollback()
+            busy = False  # e.g. the database was locked, try again shortly
+        if not busy:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+
+
+def start_workers(count=WORKERS):
+    # start the worker threads once per process, safe to call on every rerun
+    with _workers_lock:
+        while len(_workers) < count:
+            t = threading.Thread(target=_worker, name=f"report-worker-{len(_workers)}", daemon=True)
+            t.start()
+            _workers.append(t)
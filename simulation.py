@@ -0,0 +1,440 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import timing
+
+# scipy is imported inside the functions that need it, importing this module
+# (e.g. just for price_estimate) stays cheap
+
+# Surface engine for the pothole simulation.
+#
+# Every pothole is a gaussian depression  -depth * exp(-(dx^2 + dy^2) / (2 w^2))
+# and a gaussian is separable, so on a regular x/y grid it is just the outer
+# product of two 1-D profiles. Instead of one full-grid np.exp per pothole we
+# build the 1-D profiles for a batch of potholes and let one matrix product
+# add the whole batch into the surface:
+#
+#     Z = -(Gy * depths).T @ Gx        Gy: (batch, ny)   Gx: (batch, nx)
+#
+# Each profile is cut off `cutoff` widths away from its center. The part that
+# is dropped is never bigger than depth * exp(-cutoff^2 / 2) for any grid
+# point, so compared with the old full-grid loop
+#
+#     max |Z_new - Z_old| <= sum(depths) * exp(-cutoff^2 / 2)
+#
+# With the default cutoff of 6 widths that is 1.5e-8 per unit of depth
+# (under 5e-6 for the 300 potholes the company page allows). cutoff=None
+# keeps the full profiles and only float rounding differs (~1e-12).
+#
+# When the windows are small compared with the grid (big grids, narrow
+# potholes) each pothole is instead "splatted" into its own window, so the
+# cost follows the pothole area and not the grid area.
+
+DEFAULT_CUTOFF = 6.0
+BATCH_SIZE = 256
+BAND_ELEMENTS = 256 * 1024  # grid points per row band of temporaries
+
+
+def _band_rows(width):
+    return max(1, BAND_ELEMENTS // max(1, width))
+
+
+def truncation_error(depths, cutoff=DEFAULT_CUTOFF):
+    # worst case pointwise difference from the untruncated surface
+    if cutoff is None:
+        return 0.0
+    return float(np.sum(np.abs(depths)) * np.exp(-0.5 * cutoff**2))
+
+
+def _windows(axis, centers, widths, cutoff):
+    # index range [lo, hi) of the grid points within cutoff widths of each center
+    if cutoff is None:
+        n = len(centers)
+        return np.zeros(n, dtype=np.intp), np.full(n, len(axis), dtype=np.intp)
+    lo = np.searchsorted(axis, centers - cutoff * widths, side="left")
+    hi = np.searchsorted(axis, centers + cutoff * widths, side="right")
+    return lo, hi
+
+
+def _profiles(axis, centers, widths, lo, hi):
+    # 1-D gaussian profiles of a batch of potholes, zero outside their window
+    g = np.exp(-((axis[None, :] - centers[:, None]) ** 2) / (2 * widths[:, None] ** 2))
+    idx = np.arange(len(axis))
+    g[(idx[None, :] < lo[:, None]) | (idx[None, :] >= hi[:, None])] = 0.0
+    return g
+
+
+def _surface_gemm(x, y, cx, cy, depths, widths, cutoff, batch_size, Z):
+    rows = _band_rows(len(x))
+    xlo, xhi = _windows(x, cx, widths, cutoff)
+    ylo, yhi = _windows(y, cy, widths, cutoff)
+    for s in range(0, len(cx), batch_size):
+        b = slice(s, s + batch_size)
+        gx = _profiles(x, cx[b], widths[b], xlo[b], xhi[b])
+        gy = (_profiles(y, cy[b], widths[b], ylo[b], yhi[b]) * depths[b, None]).T
+        # a band of rows at a time, so the product never needs a second
+        # full grid sized temporary
+        for r in range(0, len(y), rows):
+            Z[r:r + rows] -= gy[r:r + rows] @ gx
+    return Z
+
+
+def _surface_splat(x, y, cx, cy, depths, widths, cutoff, Z):
+    xlo, xhi = _windows(x, cx, widths, cutoff)
+    ylo, yhi = _windows(y, cy, widths, cutoff)
+    for i in range(len(cx)):
+        if xlo[i] >= xhi[i] or ylo[i] >= yhi[i]:
+            continue
+        xs = x[xlo[i]:xhi[i]]
+        ys = y[ylo[i]:yhi[i]]
+        two_w2 = 2 * widths[i] ** 2
+        gx = np.exp(-((xs - cx[i]) ** 2) / two_w2)
+        gy = np.exp(-((ys - cy[i]) ** 2) / two_w2) * depths[i]
+        Z[ylo[i]:yhi[i], xlo[i]:xhi[i]] -= np.outer(gy, gx)
+    return Z
+
+
+def pothole_surface(x, y, centers, depths, widths, cutoff=DEFAULT_CUTOFF,
+                    method="auto", batch_size=BATCH_SIZE, dtype=np.float64):
+    # Same surface as summing every pothole over np.meshgrid(x, y), shape (len(y), len(x)).
+    # x and y must be sorted ascending (np.linspace grids).
+    x = np.asarray(x, dtype=dtype)
+    y = np.asarray(y, dtype=dtype)
+    centers = np.asarray(centers, dtype=dtype).reshape(-1, 2)
+    depths = np.asarray(depths, dtype=dtype)
+    widths = np.asarray(widths, dtype=dtype)
+    cx, cy = centers[:, 0], centers[:, 1]
+    Z = np.zeros((len(y), len(x)), dtype=dtype)
+    if len(cx) == 0:
+        return Z
+
+    if method == "auto":
+        # splat when the average window covers only a small part of the grid
+        if cutoff is None:
+            method = "gemm"
+        else:
+            xlo, xhi = _windows(x, cx, widths, cutoff)
+            ylo, yhi = _windows(y, cy, widths, cutoff)
+            covered = np.mean((xhi - xlo) * (yhi - ylo)) / Z.size
+            method = "splat" if covered < 0.05 else "gemm"
+
+    if method == "gemm":
+        return _surface_gemm(x, y, cx, cy, depths, widths, cutoff, batch_size, Z)
+    if method == "splat":
+        return _surface_splat(x, y, cx, cy, depths, widths, cutoff, Z)
+    raise ValueError(f"unknown surface method {method!r}")
+
+
+def noise_envelope(x, y):
+    # exp(-0.5 * (X**2 + Y**2)) without building the meshgrid
+    return np.outer(np.exp(-0.5 * np.asarray(y) ** 2), np.exp(-0.5 * np.asarray(x) ** 2))
+
+
+# -------------------- Surface / volume stage --------------------
+# The company page simulation only depends on (grid_size, num_potholes, seed),
+# so the expensive part (surface, smoothing, volumes) is computed once per key
+# and kept in a small LRU. Pricing is cheap and runs on every slider change.
+
+CACHE_MAX_ENTRIES = 16
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+
+GRID_EXTENT = 25  # the road patch is [-25, 25] x [-25, 25]
+NOISE_AMPLITUDE = 0.4  # depth noise is uniform in [-0.4, 0.4] times the envelope
+SMOOTH_SIGMA = 2  # gaussian_filter sigma, in grid cells
+
+
+def pothole_params(num_potholes, seed=50):
+    # Define random pothole centers, depths, and widths
+    # (RandomState(seed) draws the same numbers as np.random.seed(seed) did)
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(-3*10, 3*10, (num_potholes, 2))  # Random locations
+    depths = rng.uniform(1, 1, num_potholes)  # Random depths
+    widths = rng.uniform(0.8*10, 1.5*10, num_potholes)  # Random width variations
+    return rng, centers, depths, widths
+
+
+# Low-memory mode (simulate_surface(..., low_memory=True)) keeps a single
+# float32 surface and nothing else of grid size: the noise is drawn and added
+# a band of rows at a time (the same random numbers as one big draw), the
+# clipping is in place, and only the deepest point of the smoothed surface is
+# needed, so the smoothing runs band by band with a halo of the filter radius
+# instead of producing a second full array. Peak memory drops from about
+# six float64 grids to little more than one float32 grid. Results agree with the default
+# mode to float32 precision.
+def _smoothed_min(Z, sigma):
+    # min(gaussian_filter(Z, sigma)) computed in row bands; every band carries
+    # `radius` extra rows on both sides so its own rows see the same
+    # neighbours (and the same reflected edges) as the full filter would
+    from scipy.ndimage import gaussian_filter
+
+    radius = int(4.0 * sigma + 0.5)  # gaussian_filter's default truncate=4.0
+    n = Z.shape[0]
+    band = max(_band_rows(Z.shape[1]), radius)
+    best = np.inf
+    for r0 in range(0, n, band):
+        r1 = min(n, r0 + band)
+        lo, hi = max(0, r0 - radius), min(n, r1 + radius)
+        smoothed = gaussian_filter(Z[lo:hi], sigma=sigma)
+        best = min(best, float(smoothed[r0 - lo:r1 - lo].min()))
+    return best
+
+
+def simulate_surface(grid_size=100, num_potholes=5, seed=50, low_memory=False):
+    # Create the grid
+    x = np.linspace(-GRID_EXTENT, GRID_EXTENT, grid_size)
+    y = np.linspace(-GRID_EXTENT, GRID_EXTENT, grid_size)
+
+    rng, centers, depths, widths = pothole_params(num_potholes, seed)
+    dtype = np.float32 if low_memory else np.float64
+
+    # Generate multiple potholes
+    with timing.span("simulation.surface"):
+        Z_multi_uneven = pothole_surface(x, y, centers, depths, widths, dtype=dtype)
+
+    # Add depth-only noise for an uneven bottom
+    if low_memory:
+        ex = np.exp(-0.5 * x ** 2)
+        band = _band_rows(grid_size)
+        for r0 in range(0, grid_size, band):
+            r1 = min(grid_size, r0 + band)
+            noise = (rng.rand(r1 - r0, grid_size) - 0.5) * 2 * NOISE_AMPLITUDE
+            noise *= np.exp(-0.5 * y[r0:r1, None] ** 2) * ex
+            Z_multi_uneven[r0:r1] += noise
+    else:
+        depth_noise_multi = (rng.rand(grid_size, grid_size) - 0.5) * 2 * NOISE_AMPLITUDE
+        Z_multi_uneven += depth_noise_multi * noise_envelope(x, y)
+
+    # Ensure the road surface remains flat at the top
+    np.minimum(0, Z_multi_uneven, out=Z_multi_uneven)
+
+    # Apply Gaussian smoothing to the pothole bottoms
+    with timing.span("simulation.gaussian_filter"):
+        from scipy.ndimage import gaussian_filter
+
+        if low_memory:
+            deepest = _smoothed_min(Z_multi_uneven, SMOOTH_SIGMA)
+        else:
+            deepest = np.min(gaussian_filter(Z_multi_uneven, sigma=SMOOTH_SIGMA))
+
+    # Find the max dimensions
+    max_length = x[-1] - x[0]  # X-axis range
+    max_height = y[-1] - y[0]  # Y-axis range
+    max_depth = round(np.abs(deepest), 2)  # Max depth
+
+    # Calculate volumes
+    dx_original = np.abs(x[1] - x[0])
+    dy_original = np.abs(y[1] - y[0])
+    if low_memory:
+        # Z <= 0 after the clipping, so sum(|Z|) is -sum(Z), no temporary
+        volume_original = -Z_multi_uneven.sum(dtype=np.float64) * dx_original * dy_original
+    else:
+        volume_original = np.sum(np.abs(Z_multi_uneven) * dx_original * dy_original)
+
+    return {
+        "x": x,
+        "y": y,
+        "Z": Z_multi_uneven,
+        "max_length": max_length,
+        "max_height": max_height,
+        "max_depth": max_depth,
+        "volume_original": volume_original,
+    }
+
+
+def _entry_bytes(entry):
+    return sum(v.nbytes if isinstance(v, np.ndarray) else len(v)
+               for v in entry.values() if isinstance(v, (np.ndarray, bytes)))
+
+
+def _evict():
+    # drop least recently used entries until both limits hold (lock held)
+    global _cache_bytes
+    while _cache and (len(_cache) > CACHE_MAX_ENTRIES or _cache_bytes > CACHE_MAX_BYTES):
+        _, old = _cache.popitem(last=False)
+        _cache_bytes -= _entry_bytes(old)
+
+
+@timing.timed("simulation.cached_surface")
+def cached_surface(grid_size=100, num_potholes=5, seed=50, low_memory=False):
+    # LRU over simulate_surface, bounded by CACHE_MAX_ENTRIES and CACHE_MAX_BYTES.
+    # The returned dict is shared between sessions, treat the arrays as read only.
+    global _cache_bytes
+    key = (grid_size, num_potholes, seed, low_memory)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    entry = simulate_surface(grid_size, num_potholes, seed, low_memory)
+    with _cache_lock:
+        if key in _cache:  # another session got here first
+            return _cache[key]
+        _cache[key] = entry
+        _cache_bytes += _entry_bytes(entry)
+        _evict()
+    return entry
+
+
+def cache_extra(entry, name, value):
+    # store a derived value (e.g. the rendered plot) on a cached entry so it
+    # is counted against the memory cap and dropped together with the surface
+    global _cache_bytes
+    with _cache_lock:
+        cached = any(v is entry for v in _cache.values())
+        if cached:
+            _cache_bytes -= _entry_bytes(entry)
+        entry[name] = value
+        if cached:
+            _cache_bytes += _entry_bytes(entry)
+            _evict()
+
+
+def clear_cache():
+    global _cache_bytes
+    with _cache_lock:
+        _cache.clear()
+        _cache_bytes = 0
+
+
+# -------------------- Analytic volume --------------------
+# Volume and cost without building (or smoothing) the surface.
+#
+# The rough surface is  Z = min(0, G + N)  with G the sum of the gaussian
+# depressions and N the depth noise, |N| <= NOISE_AMPLITUDE * envelope.
+# G <= 0 everywhere, so |Z| differs from |G| by at most |N| at every point,
+# and the depressions simply add up where they overlap. That gives
+#
+#     volume = sum over potholes of depth * Sx * Sy        (+- noise bound)
+#
+# where Sx, Sy are the 1-D integrals of the pothole's gaussian over the
+# road patch (clipping at the patch edge included):
+#
+#   method="grid"      Sx, Sy are the sums over the grid points times dx,
+#                      i.e. exactly the gaussian part of the grid volume.
+#                      O(num_potholes x grid_size), no 2-D array.
+#   method="integral"  Sx, Sy are erf closed forms, the continuous volume.
+#                      O(num_potholes), independent of the grid size.
+#
+# error_bound is NOISE_AMPLITUDE times the envelope integral; the grid
+# volume from simulate_surface is always within it for method="grid"
+# (and the continuous volume for method="integral").
+#
+# The max depth used for the cuboid price is estimated by smoothing each
+# gaussian analytically (a gaussian blurred by a gaussian is a wider,
+# shallower gaussian) and taking the deepest point on a lattice of the
+# patch. It ignores the noise and edge effects of gaussian_filter, so it
+# is an estimate rather than a bound.
+
+BATCH_ELEMENTS = 4_000_000  # max elements of any temporary array
+
+
+def _grid_profile_sums(axis, centers, widths):
+    # sum over axis of exp(-(a - c)^2 / 2 w^2) for every pothole, in batches;
+    # centers and widths can have any (matching) shape
+    shape = np.shape(centers)
+    centers, widths = np.ravel(centers), np.ravel(widths)
+    out = np.empty(len(centers))
+    step = max(1, BATCH_ELEMENTS // max(1, len(axis)))
+    for s in range(0, len(centers), step):
+        b = slice(s, s + step)
+        out[b] = np.exp(-((axis[None, :] - centers[b, None]) ** 2) / (2 * widths[b, None] ** 2)).sum(axis=1)
+    return out.reshape(shape)
+
+
+def _erf_integrals(centers, widths, lo=-GRID_EXTENT, hi=GRID_EXTENT):
+    # integral over [lo, hi] of exp(-(a - c)^2 / 2 w^2)
+    from scipy.special import erf
+
+    r = np.sqrt(2) * widths
+    return widths * np.sqrt(np.pi / 2) * (erf((hi - centers) / r) - erf((lo - centers) / r))
+
+
+def volume_terms(centers, depths, widths, grid_size, method="grid"):
+    # (volume, error_bound) of scenes given by centers (..., P, 2),
+    # depths and widths (..., P); leading axes are independent scenes
+    cx, cy = centers[..., 0], centers[..., 1]
+    if method == "grid":
+        x = np.linspace(-GRID_EXTENT, GRID_EXTENT, grid_size)
+        dx = x[1] - x[0]
+        sx = _grid_profile_sums(x, cx, widths) * dx
+        sy = _grid_profile_sums(x, cy, widths) * dx
+        envelope = np.exp(-0.5 * x ** 2).sum() * dx
+    elif method == "integral":
+        sx = _erf_integrals(cx, widths)
+        sy = _erf_integrals(cy, widths)
+        envelope = _erf_integrals(0.0, 1.0)
+    else:
+        raise ValueError(f"unknown volume method {method!r}")
+    return np.sum(depths * sx * sy, axis=-1), NOISE_AMPLITUDE * envelope ** 2
+
+
+def smoothed_max_depth(centers, depths, widths, grid_size):
+    # deepest point of the analytically smoothed depressions over a lattice
+    # of the patch, per scene (same shapes as volume_terms). The smoothed
+    # gaussians are separable, so the depth on the whole lattice is one
+    # matrix product of their x and y profiles (as in _surface_gemm):
+    # O(potholes x lattice) per scene, however many potholes overlap.
+    sigma = SMOOTH_SIGMA * 2 * GRID_EXTENT / (grid_size - 1)
+    s2 = widths ** 2 + sigma ** 2
+    amp = depths * widths ** 2 / s2
+    # a quarter of the narrowest smoothed width apart, the lattice maximum is
+    # then within about 1% of the true one; never finer than the grid
+    spacing = np.sqrt(s2.min()) / 4 if s2.size else 2 * GRID_EXTENT
+    m = int(min(grid_size, np.ceil(2 * GRID_EXTENT / spacing) + 1))
+    axis = np.linspace(-GRID_EXTENT, GRID_EXTENT, m)
+
+    scenes = centers.shape[:-2]
+    n = centers.shape[-2]
+    cx, cy = centers[..., 0].reshape(-1, n), centers[..., 1].reshape(-1, n)
+    s2, amp = s2.reshape(-1, n), amp.reshape(-1, n)
+    best = np.zeros(len(cx))
+    step = max(1, BATCH_ELEMENTS // max(1, n * m))
+    for s in range(0, len(cx), step):
+        b = slice(s, s + step)
+        gx = np.exp(-(axis[None, :, None] - cx[b, None, :]) ** 2 / (2 * s2[b, None, :]))
+        gy = np.exp(-(axis[None, :, None] - cy[b, None, :]) ** 2 / (2 * s2[b, None, :]))
+        depth = np.matmul(gx * amp[b, None, :], gy.transpose(0, 2, 1))
+        best[b] = depth.reshape(len(depth), -1).max(axis=1, initial=0.0)
+    return best.reshape(scenes)
+
+
+@timing.timed("simulation.estimate_volume")
+def estimate_volume(grid_size=100, num_potholes=5, seed=50, method="grid"):
+    _, centers, depths, widths = pothole_params(num_potholes, seed)
+    volume, bound = volume_terms(centers, depths, widths, grid_size, method)
+    return {
+        "volume_original": float(volume),
+        "error_bound": float(bound),
+        "max_length": 2.0 * GRID_EXTENT,
+        "max_height": 2.0 * GRID_EXTENT,
+        "max_depth": round(float(smoothed_max_depth(centers, depths, widths, grid_size)), 2),
+        "method": method,
+    }
+
+
+# -------------------- Pricing stage --------------------
+
+def fill_cost(volume_m3, rate):
+    # rs for volume_m3 of fill at rate thousands of rs per m3 (numbers or arrays)
+    return volume_m3*rate*1000
+
+
+def price_estimate(max_depth, max_height, max_length, selling_slider, manu_slider):
+    # sliders are in thousands of rs per m3, dimensions in cm
+    cuboid_m3 = (max_depth*0.01)*max_height*0.01*max_length*0.01
+    sp = round(fill_cost(cuboid_m3, selling_slider), 2)
+    mp = round(fill_cost(cuboid_m3, manu_slider), 2)
+    return {
+        "cuboid": max_depth*max_height*max_length,
+        "selling_price": sp,
+        "manufacturing_price": mp,
+        "profit": round(sp-mp, 2),
+        "margin": round(((sp-mp)/sp)*100, 2),
+    }
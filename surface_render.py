@@ -0,0 +1,115 @@
+from io import BytesIO
+
+import numpy as np
+
+import timing
+
+# Level-of-detail rendering for the pothole surfaces.
+#
+# plot_surface draws one polygon per grid cell (plus its edge stroke), so the
+# render cost and the PNG size grow with grid_size^2. Here the surface is
+# decimated to a vertex budget before plotting and the edge strokes are only
+# drawn while the mesh is coarse enough for them to be readable.
+# Decimation is for display only, volumes are always taken from the full grid.
+# matplotlib and pydeck are only imported by the renderer that uses them.
+
+DEFAULT_MAX_VERTICES = 100 * 100
+EDGE_MAX_VERTICES = 60 * 60
+
+
+def decimation_step(shape, max_vertices=DEFAULT_MAX_VERTICES):
+    ny, nx = shape
+    if max_vertices is None or ny * nx <= max_vertices:
+        return 1
+    return int(np.ceil(np.sqrt(ny * nx / max_vertices)))
+
+
+def decimate_surface(x, y, Z, max_vertices=DEFAULT_MAX_VERTICES, pool="min"):
+    # Reduce (x, y, Z) to at most ~max_vertices points.
+    # pool="stride" keeps every step-th sample. pool="min" keeps the deepest
+    # sample of each step x step block, so the pothole bottoms (and the max
+    # depth shown in the title) do not disappear from the picture.
+    # Returns x, y, Z and the largest |Z| change inside a block, which bounds
+    # how far the drawn surface is from the real one.
+    step = decimation_step(Z.shape, max_vertices)
+    if step == 1:
+        return x, y, Z, 0.0
+
+    ny, nx = Z.shape
+    # pad to a whole number of blocks by repeating the last row/column
+    py, px = (-ny) % step, (-nx) % step
+    Zp = np.pad(Z, ((0, py), (0, px)), mode="edge")
+    blocks = Zp.reshape(Zp.shape[0] // step, step, Zp.shape[1] // step, step)
+    block_min = blocks.min(axis=(1, 3))
+    error = float((blocks.max(axis=(1, 3)) - block_min).max())
+
+    if pool == "min":
+        Zd = block_min
+        # block centers, clipped to the grid
+        xs = np.minimum(np.arange(Zd.shape[1]) * step + step // 2, nx - 1)
+        ys = np.minimum(np.arange(Zd.shape[0]) * step + step // 2, ny - 1)
+    elif pool == "stride":
+        # keep the last row/column so the plotted extent matches the full grid
+        xs = np.unique(np.append(np.arange(0, nx, step), nx - 1))
+        ys = np.unique(np.append(np.arange(0, ny, step), ny - 1))
+        Zd = Z[np.ix_(ys, xs)]
+    else:
+        raise ValueError(f"unknown pool mode {pool!r}")
+
+    return x[xs], y[ys], Zd, error
+
+
+@timing.timed("render.plot_surface")
+def render_surface_png(sim, max_vertices=DEFAULT_MAX_VERTICES, edge_max_vertices=EDGE_MAX_VERTICES, pool="min"):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    x, y, Z, _ = decimate_surface(sim["x"], sim["y"], sim["Z"], max_vertices, pool)
+    X, Y = np.meshgrid(x, y)
+    edgecolor = 'k' if Z.size <= edge_max_vertices else 'none'
+
+    # Plot Original Rough Pothole Surface
+    fig = plt.figure(figsize=(7, 5.5))
+    ax = fig.add_subplot(projection="3d")
+    ax.plot_surface(X, Y, Z, cmap='gray', edgecolor=edgecolor, linewidth=0.3 if edgecolor == 'k' else 0,
+                    rstride=1, cstride=1, antialiased=False)
+    ax.set_title(f"Original Rough Potholes\nLength: {sim['max_length']:.2f}, Height: {sim['max_height']:.2f}, Depth: {sim['max_depth']:.2f}\nVolume: {sim['volume_original']:.2f} cubic units")
+    ax.set_xlabel("X-axis")
+    ax.set_ylabel("Y-axis")
+    ax.set_zlabel("Depth")
+
+    buffered = BytesIO()
+    fig.savefig(buffered, format="png")
+    plt.close(fig)
+    return buffered.getvalue()
+
+
+@timing.timed("render.surface_deck")
+def surface_deck(sim, max_vertices=DEFAULT_MAX_VERTICES, pool="min"):
+    # Interactive WebGL view of the decimated surface as a pydeck point cloud
+    # (orbit view, plain cartesian coordinates). The browser does the 3D work,
+    # so only the vertex list is sent instead of a rendered image.
+    import pydeck as pdk
+
+    x, y, Z, _ = decimate_surface(sim["x"], sim["y"], sim["Z"], max_vertices, pool)
+    X, Y = np.meshgrid(x, y)
+    depth = float(-Z.min()) or 1.0
+    # exaggerate depth so it is visible next to the 50 unit wide road patch
+    z_scale = 0.25 * (x[-1] - x[0]) / depth
+    shade = (255 * (1 + Z / depth)).clip(0, 255).astype(int)
+    points = [
+        {"position": [float(px), float(py), float(pz * z_scale)], "color": [int(c), int(c), int(c)]}
+        for px, py, pz, c in zip(X.ravel(), Y.ravel(), Z.ravel(), shade.ravel())
+    ]
+    layer = pdk.Layer(
+        "PointCloudLayer",
+        points,
+        coordinate_system=0,  # deck.gl COORDINATE_SYSTEM.CARTESIAN
+        get_position="position",
+        get_color="color",
+        point_size=3,
+    )
+    view = pdk.View(type="OrbitView", controller=True)
+    view_state = pdk.ViewState(target=[0, 0, 0], rotation_orbit=30, rotation_x=30, zoom=3)
+    return pdk.Deck(layers=[layer], views=[view], initial_view_state=view_state, map_provider=None)
@@ -0,0 +1,174 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Lightweight stage timing.
+#
+#     with timing.span("db.query"):
+#         ...
+#
+#     @timing.timed("geocode.reverse")
+#     def reverse_location(...):
+#
+# Every finished span
+#   - is logged as one JSON line on the "ecoroad.timing" logger (DEBUG),
+#     written to the file named by ECOROAD_TIMING_LOG (if set),
+#   - goes into a rolling window of the last WINDOW durations of its stage,
+#     from which percentiles are computed,
+#   - is added to the breakdown of the current page run (per thread, reset
+#     by start_run()).
+#
+# Pages call start_run() at the top and finish_run() at the bottom.
+# finish_run() shows the breakdown and percentiles when the page is opened
+# with ?debug=1, and rewrites the Prometheus text file named by
+# ECOROAD_METRICS_FILE (if set) for the local scraper.
+
+WINDOW = 1000
+QUANTILES = (0.5, 0.9, 0.99)
+METRICS_FILE = os.environ.get("ECOROAD_METRICS_FILE")
+LOG_FILE = os.environ.get("ECOROAD_TIMING_LOG")
+
+log = logging.getLogger("ecoroad.timing")
+
+
+def log_to_file(path):
+    # send the span log to path, one JSON object per line
+    if any(getattr(h, "baseFilename", None) == os.path.abspath(path) for h in log.handlers):
+        return  # already set up (modules can be imported again by the pages)
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+
+
+if LOG_FILE:
+    log_to_file(LOG_FILE)
+
+_lock = threading.Lock()
+_windows = defaultdict(lambda: deque(maxlen=WINDOW))
+_totals = defaultdict(lambda: [0, 0.0])  # stage -> [count, sum seconds], since start
+_run = threading.local()
+
+
+@contextmanager
+def span(name, **labels):
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record(name, time.perf_counter() - start, error=error, **labels)
+
+
+def timed(name):
+    # decorator form of span
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def record(name, seconds, **labels):
+    with _lock:
+        _windows[name].append(seconds)
+        total = _totals[name]
+        total[0] += 1
+        total[1] += seconds
+    spans = getattr(_run, "spans", None)
+    if spans is not None:
+        spans.append((name, seconds))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(json.dumps({"stage": name, "ms": round(seconds * 1000, 3), "ts": time.time(), **labels}))
+
+
+def start_run():
+    # begin collecting the stages of one page run on this thread
+    _run.spans = []
+    _run.start = time.perf_counter()
+
+
+def run_breakdown():
+    # [(stage, seconds)] of the current run in the order they finished
+    return list(getattr(_run, "spans", None) or [])
+
+
+def _quantile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    pos = q * (len(values) - 1)
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def percentiles():
+    # {stage: {"count": n, "p50": s, "p90": s, "p99": s}} over the rolling windows
+    with _lock:
+        windows = {name: list(w) for name, w in _windows.items()}
+        totals = {name: tuple(t) for name, t in _totals.items()}
+    return {
+        name: {"count": totals[name][0], "sum": totals[name][1],
+               **{f"p{int(q * 100)}": _quantile(values, q) for q in QUANTILES}}
+        for name, values in windows.items()
+    }
+
+
+def prometheus_text():
+    lines = [
+        "# HELP ecoroad_stage_seconds Duration of EcoRoad stages (rolling window quantiles).",
+        "# TYPE ecoroad_stage_seconds summary",
+    ]
+    for name, stats in sorted(percentiles().items()):
+        for q in QUANTILES:
+            lines.append(f'ecoroad_stage_seconds{{stage="{name}",quantile="{q}"}} {stats[f"p{int(q * 100)}"]:.6f}')
+        lines.append(f'ecoroad_stage_seconds_sum{{stage="{name}"}} {stats["sum"]:.6f}')
+        lines.append(f'ecoroad_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    # atomic rewrite, so the scraper never reads half a file
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+def finish_run(page="run"):
+    # end of a page run: export metrics and show the debug panel if asked for
+    start = getattr(_run, "start", None)
+    if start is not None:
+        record(f"page.{page}", time.perf_counter() - start)
+    if METRICS_FILE:
+        try:
+            write_prometheus(METRICS_FILE)
+        except OSError:
+            log.warning("could not write metrics to %s", METRICS_FILE)
+
+    import streamlit as st
+
+    if st.query_params.get("debug") != "1":
+        return
+    with st.expander("⏱️ Debug: stage timings", expanded=True):
+        rows = [{"stage": name, "ms": round(seconds * 1000, 2)} for name, seconds in run_breakdown()]
+        st.markdown("**This run**")
+        st.dataframe(rows, use_container_width=True)
+        st.markdown(f"**Rolling percentiles** (last {WINDOW} per stage)")
+        st.dataframe([
+            {"stage": name, "count": s["count"], "p50 ms": round(s["p50"] * 1000, 2),
+             "p90 ms": round(s["p90"] * 1000, 2), "p99 ms": round(s["p99"] * 1000, 2)}
+            for name, s in sorted(percentiles().items())
+        ], use_container_width=True)
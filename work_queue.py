@@ -0,0 +1,148 @@
+import data_storage
+import timing
+
+# Repair work queue over the stored reports.
+#
+#     work_queue.verify([12, 15])                  # checked, ready for a crew
+#     jobs = work_queue.claim("crew-7", 3, state="Kerala")
+#     work_queue.transition([jobs[0]["slno"]], work_queue.FILLED, crew="crew-7")
+#
+# A report moves through user_data.status
+#
+#     submitted (s) -> verified (v) -> scheduled (c) -> filled (f)
+#
+# and a scheduled job can be released back to verified. New reports come in
+# as submitted, filled is the status the rest of the app already knew.
+# Every move is one UPDATE on the data_storage writer thread whose WHERE
+# clause checks the current status, so two clients can never move the same
+# report twice (e.g. two crews claiming it), also across processes, since
+# SQLite takes the write lock per transaction.
+#
+# Jobs are handed out biggest estimated fill volume (breadth x length x
+# height) first. next_jobs() and claim() walk the status / priority indexes
+# from data_storage, so they read about as many rows as they return however
+# long the backlog is.
+
+SUBMITTED, VERIFIED, SCHEDULED, FILLED = "s", "v", "c", "f"
+STATUS_NAMES = {SUBMITTED: "Submitted", VERIFIED: "Verified", SCHEDULED: "Scheduled", FILLED: "Filled"}
+OPEN = (SUBMITTED, VERIFIED, SCHEDULED)  # not filled yet
+TRANSITIONS = {  # status -> where it may move from there
+    SUBMITTED: (VERIFIED,),
+    VERIFIED: (SCHEDULED,),
+    SCHEDULED: (FILLED, VERIFIED),
+    FILLED: (),
+}
+FEED_COLUMNS = ["slno", "address", "lat", "long", "city", "state", "breadth", "length", "height", "datime"]
+STALE_HOURS = 72
+
+_NOW = "datetime('now', '+5 hours', '30 minutes')"  # same clock as user_data.datime
+
+
+def _sources(status):
+    # statuses a report may be moved to status from
+    if status not in TRANSITIONS:
+        raise ValueError(f"unknown status {status!r}")
+    return [i for i, targets in TRANSITIONS.items() if status in targets]
+
+
+def _place(state, city):
+    # extra where clause for the feeds, only equality so the indexes apply
+    where, params = "", []
+    for name, value in (("state", state), ("city", city)):
+        if value is not None:
+            where += f" and {name} = ?"
+            params.append(value)
+    return where, params
+
+
+def _jobs(rows, columns):
+    return [dict(zip(columns, row)) for row in rows]
+
+
+@timing.timed("queue.transition")
+def transition(slnos, status, crew=None):
+    # move the reports that are allowed to go to status, returns the slnos
+    # that moved (the others were already moved on by someone else).
+    # Scheduling needs the crew; when releasing or completing a job, crew=
+    # only lets that crew's jobs through.
+    sources = _sources(status)
+    if isinstance(slnos, int):
+        slnos = [slnos]
+    slnos = list(slnos)
+    if not slnos or not sources:
+        return []
+    if status == SCHEDULED and crew is None:
+        raise ValueError("scheduling a job needs a crew")
+
+    sets, params = ["status = ?", f"status_changed = {_NOW}"], [status]
+    if status == SCHEDULED:
+        sets.append("crew = ?")
+        params.append(crew)
+    elif status != FILLED:
+        sets.append("crew = null")  # back in the pool; filled jobs keep who did them
+    where = f"slno in ({','.join('?' * len(slnos))}) and status in ({','.join('?' * len(sources))})"
+    params += slnos + sources
+    if crew is not None and status != SCHEDULED:
+        where += " and crew = ?"
+        params.append(crew)
+    sql = f"update user_data set {', '.join(sets)} where {where} returning slno"
+    return sorted(i for i, in data_storage.write(lambda conn: conn.execute(sql, params).fetchall()))
+
+
+def verify(slnos):
+    # submitted reports checked by the office, ready for the crews
+    return transition(slnos, VERIFIED)
+
+
+@timing.timed("queue.next_jobs")
+def next_jobs(limit=20, status=VERIFIED, state=None, city=None, columns=FEED_COLUMNS):
+    # [{column: value}] of the jobs with this status, biggest first. Reading
+    # only, use claim() to take them.
+    if status not in TRANSITIONS:
+        raise ValueError(f"unknown status {status!r}")
+    columns = data_storage._columns(columns)
+    where, params = _place(state, city)
+    rows = data_storage.connect().execute(
+        f"""select {', '.join(columns)} from user_data where status = ?{where}
+            order by {data_storage.FILL_VOLUME} desc, slno limit ?""", [status, *params, int(limit)]).fetchall()
+    return _jobs(rows, columns)
+
+
+@timing.timed("queue.claim")
+def claim(crew, count=1, state=None, city=None, columns=FEED_COLUMNS):
+    # atomically schedule the count biggest verified jobs (in state / city)
+    # for crew and return them biggest first, [] when there are none left.
+    # Concurrent claims each get different jobs.
+    columns = data_storage._columns(columns)
+    where, params = _place(state, city)
+    volume = data_storage.FILL_VOLUME
+    sql = f"""update user_data set status = ?, crew = ?, status_changed = {_NOW}
+              where slno in (select slno from user_data where status = ?{where}
+                             order by {volume} desc, slno limit ?)
+              and status = ?
+              returning {volume}, {', '.join(columns)}"""
+    params = [SCHEDULED, crew, VERIFIED, *params, int(count), VERIFIED]
+    rows = data_storage.write(lambda conn: conn.execute(sql, params).fetchall())
+    # RETURNING gives no order, the subquery picked them by priority
+    rows.sort(key=lambda row: -row[0])
+    return _jobs([row[1:] for row in rows], columns)
+
+
+@timing.timed("queue.crew_jobs")
+def crew_jobs(crew, columns=FEED_COLUMNS):
+    # the jobs crew holds at the moment, biggest first
+    columns = data_storage._columns(columns)
+    rows = data_storage.connect().execute(
+        f"""select {', '.join(columns)} from user_data where crew = ? and status = ?
+            order by {data_storage.FILL_VOLUME} desc, slno""", (crew, SCHEDULED)).fetchall()
+    return _jobs(rows, columns)
+
+
+def release_stale(hours=STALE_HOURS):
+    # put jobs scheduled more than hours ago and never filled back in the
+    # pool, returns their slnos
+    sql = f"""update user_data set status = ?, crew = null, status_changed = {_NOW}
+              where status = ? and status_changed < datetime({_NOW}, ?)
+              returning slno"""
+    params = (VERIFIED, SCHEDULED, f"-{float(hours)} hours")
+    return sorted(i for i, in data_storage.write(lambda conn: conn.execute(sql, params).fetchall()))